@@ -31,9 +31,10 @@
 # along with Prism.  If not, see <https://www.gnu.org/licenses/>.
 
 
-import os, sys, traceback, io, time, subprocess, platform
+import os, sys, traceback, io, time, hashlib
 from functools import wraps
-import trelloprism, trelloqt
+from tempfile import gettempdir
+import trelloprism, trelloqt, trelloqueue, trellomedia
 try:
     import snapdraw
 except ImportError:
@@ -68,6 +69,9 @@ class Prism_PrismTrello_Functions(object):
         self.core = core
         self.plugin = plugin
         self.trello_handler = None
+        self.publish_queue = None
+        # progress dialog of the sync that's running (or last ran) - one at a time
+        self.sync_dialog = None
 
 
     # if returns true, the plugin will be loaded by Prism
@@ -89,12 +93,46 @@ class Prism_PrismTrello_Functions(object):
     @err_catcher(name=__name__)
     def reload_handler(self):
         """
-        Refresh the handler object and ensure connection.
+        Refresh the handler object and start connecting in the background.
+        Syncs & publishes wait on the connection only when they need it.
         :return:
         """
+        if self.trello_handler:
+            self.trello_handler.stop_webhooks()
         self.trello_handler = trelloprism.TrelloHandler(self.core)
-        if not self.trello_handler.is_connected:
+        queue = self.get_publish_queue()
+
+        def connected(state):
+            # once connected, anything queued can go
+            queue.wake.set()
+            if state == "connected":
+                self.start_webhooks()
+        self.trello_handler.connect_async(callback=connected)
+
+
+    def get_handler(self):
+        """
+        Get the handler for the current project. It's kept around between publishes (along with
+        its open connections), and only made again if there isn't one or the project changed.
+        :return: TrelloHandler
+        """
+        if not self.trello_handler or self.trello_handler.project != self.core.prismIni:
+            if self.trello_handler:
+                self.trello_handler.stop_webhooks()
+            self.trello_handler = trelloprism.TrelloHandler(self.core)
+        return self.trello_handler
+
+
+    def connect_handler(self):
+        """
+        Make sure the handler's credentials are good, yelling at the user if they're not.
+        Only costs a request the first time (or after a 401).
+        :return: bool, whether the connection is good
+        """
+        if not self.get_handler().ensure_connected():
             QMessageBox(text="Trello connection rejected.\nCheck internet connection or Trello credentials.").exec_()
+            return False
+        return True
 
 
     @err_catcher(name=__name__)
@@ -104,16 +142,31 @@ class Prism_PrismTrello_Functions(object):
         This class is the interface.
         :return: None
         """
+        self.run_sync_down(full=False)
+
+
+    @err_catcher(name=__name__)
+    def sync_down_full(self):
+        """
+        Slot for a sync down which goes through every board, changed since last time or not.
+        :return: None
+        """
+        self.run_sync_down(full=True)
+
+
+    def run_sync_down(self, full):
+        """
+        :param full: bool - ignore the per-board watermarks and re-download everything
+        :return: None
+        """
         if not self.is_enabled():
             return
 
-        self.reload_handler()
-        win = QProgressDialog("Downloading changes from Trello...", "Cancel", 0, 1)
-        win.show()
-        def inc(): win.setValue(win.value() + 1)
-        self.trello_handler.sync_from_trello(set_max_func=win.setMaximum, increment_func=inc)
-        win.accept()
-        QMessageBox(text="Sync complete.").exec_()
+        if not self.connect_handler():
+            return
+        handler = self.trello_handler
+        self.run_sync("Downloading changes from Trello...", lambda set_max, inc, cancel: handler.sync_from_trello(
+            set_max_func=set_max, increment_func=inc, full=full, cancel=cancel))
 
 
     @err_catcher(name=__name__)
@@ -125,13 +178,42 @@ class Prism_PrismTrello_Functions(object):
         if not self.is_enabled():
             return
 
-        self.reload_handler()
-        win = QProgressDialog("Uploading changes to Trello...", "Cancel", 0, 1)
-        win.show()
-        def inc(): win.setValue(win.value() + 1)
-        self.trello_handler.sync_from_prism(set_max_func=win.setMaximum, increment_func=inc)
-        win.accept()
-        QMessageBox(text="Sync complete.").exec_()
+        if not self.connect_handler():
+            return
+        handler = self.trello_handler
+        self.run_sync("Uploading changes to Trello...", lambda set_max, inc, cancel: handler.sync_from_prism(
+            set_max_func=set_max, increment_func=inc, cancel=cancel))
+
+
+    def run_sync(self, title, func):
+        """
+        Run a sync on a worker thread behind a progress dialog, so Prism doesn't freeze meanwhile.
+        Only one sync at a time - they'd be fighting over the same boards & folders.
+        :param title: progress dialog text
+        :param func: function taking (set_max_func, increment_func, cancel event) - see trelloqt.SyncWorker
+        :return: trelloqt.SyncProgressDialog, or None if a sync is already going
+        """
+        if self.sync_dialog and self.sync_dialog.status is None:
+            self.sync_dialog.raise_()
+            return None
+        self.sync_dialog = trelloqt.SyncProgressDialog(title, func, self.trello_handler.limiter.stats)
+        self.sync_dialog.run()
+        return self.sync_dialog
+
+    @err_catcher(name=__name__)
+    def sync_up_dry_run(self):
+        """
+        Slot to print what a sync up would create on Trello, without doing it.
+        :return: None
+        """
+        if not self.is_enabled():
+            return
+
+        if not self.connect_handler():
+            return
+        plan = self.trello_handler.sync_from_prism(set_max_func=None, increment_func=None, dry_run=True)
+        QMessageBox(text="Sync would make {} boards/lists on Trello.\n"
+                         "Details printed to the console.".format(len(plan))).exec_()
 
     # the following function are called by Prism at specific events, which are indicated by the function names
     # you can add your own code to any of these functions.
@@ -148,6 +230,26 @@ class Prism_PrismTrello_Functions(object):
             return
 
         self.reload_handler()
+        # replay anything that didn't make it to Trello last session
+        self.get_publish_queue().start()
+
+
+    def get_publish_queue(self):
+        """
+        Get the publish queue of the current project, swapping it out if the project changed.
+        :return: trelloqueue.PublishQueue
+        """
+        # keyed on the project file, not the name - two projects can have the same name
+        project = os.path.normpath(self.core.prismIni)
+        key = hashlib.md5(os.path.normcase(project).encode("utf-8")).hexdigest()[:12]
+        root = os.path.join(gettempdir(), "prismtrello_queue",
+                            "{}_{}".format(self.core.validateStr(self.core.projectName), key))
+        if self.publish_queue and self.publish_queue.root != root:
+            self.publish_queue.stop()
+            self.publish_queue = None
+        if not self.publish_queue:
+            self.publish_queue = trelloqueue.PublishQueue(root, self.send_queued_publish, project=project)
+        return self.publish_queue
 
 
     @err_catcher(name=__name__)
@@ -171,7 +273,9 @@ class Prism_PrismTrello_Functions(object):
         trello_widg = trelloqt.TrelloSettingsUi(self.core, page)
         page.layout().insertWidget(6, trello_widg)
         trello_widg.sync_down_button.clicked.connect(self.sync_down)
+        trello_widg.sync_down_full_action.triggered.connect(self.sync_down_full)
         trello_widg.sync_up_button.clicked.connect(self.sync_up)
+        trello_widg.sync_up_dry_run_action.triggered.connect(self.sync_up_dry_run)
 
 
     @err_catcher(name=__name__)
@@ -211,7 +315,13 @@ class Prism_PrismTrello_Functions(object):
         and doesn't contain info about the individual states.
         """
         # print("PUBLIIIIIIIIIISH")
-        self.reload_handler()
+        # nothing here waits on Trello - the queue's worker checks the connection itself,
+        # and holds on to the publish if it's offline. only a token already known to be bad
+        # gets the user asked for a new one, since that has to happen on the main thread
+        if self.is_enabled():
+            if self.get_handler().connection_state == "unauthorized":
+                self.connect_handler()
+            self.get_publish_queue().wake.set()
 
 
     @err_catcher(name=__name__)
@@ -297,12 +407,15 @@ class Prism_PrismTrello_Functions(object):
     def publish_task_to_trello(self, task_type, task_data):
         """
         Respond to a publish and propogate the necessary change to Trello.
-        onPublish refreshes handler object, since that only runs once per publish set.
+        onPublish checks the handler's connection, since that only runs once per publish set.
+        Only the quick stuff happens here - the publish is put on the queue and the
+        encoding & Trello requests happen in the background (see send_queued_publish).
         :param task_type: Export, Playblast, or ImageRender
         :param task_data: kwargs given to the callback function
         :return: None
         """
-        if not self.is_enabled() or not self.trello_handler or not self.trello_handler.is_connected:
+        # no connection needed here - the queue holds on to it until there is one
+        if not self.is_enabled():
             return
 
         print("*************************************************************")
@@ -316,17 +429,56 @@ class Prism_PrismTrello_Functions(object):
             return
 
         data = self.get_publish_data(scene_file, publish_file, task_type)
+        data["project"] = os.path.normpath(self.core.prismIni)
         data["start_frame"], data["end_frame"] = task_data["startframe"], task_data["endframe"]
-        data["attach"], data["attach_type"] = self.get_publish_attachment(data)
-        try:
-            self.trello_handler.publish_to_card(data)
-        except:
-            raise
+        files = {}
+        if self.needs_snapshot(data):
+            # user interaction has to happen now, on the main thread
+            buf, ext = self.get_snapshot_attachment(data)
+            if buf:
+                data["attach_file"] = "attach.{}".format(ext)
+                buf.seek(0)
+                files[data["attach_file"]] = buf
+
+        job_id = self.get_publish_queue().put(data, files)
+        print("Queued Trello publish {} for {}".format(job_id, data["task"]))
 
         # db = discordbot.DiscordHandler(self.core)
         # db.post_publish_embed(data)
 
 
+    def send_queued_publish(self, data, job_dir):
+        """
+        Publish queue worker's job - runs in the background thread.
+        Make the attachment (if it wasn't grabbed up front) and push it all to Trello.
+        :param data: dict - publish data, as put on the queue
+        :param job_dir: folder of the queued job, holding any saved attachment
+        :return: None
+        """
+        handler = self.trello_handler
+        if not handler:
+            raise trelloqueue.NotReady("No Trello connection")
+        # the project was switched since it was queued - it waits for its own project's queue
+        if os.path.normpath(handler.project) != data.get("project", os.path.normpath(handler.project)):
+            raise trelloqueue.NotReady("Publish belongs to {}".format(data["project"]))
+        # waits on the project-open check if it's still going, re-checks if it came back bad
+        if handler.wait_connected() != "connected" and handler.check_token() != "connected":
+            raise trelloqueue.NotReady("Trello connection {}".format(handler.connection_state))
+
+        # the queue writes the data back out if this fails, so the attachment & full paths go on a copy.
+        # done_steps is shared - a retry has to know what already went through (see publish_to_card)
+        data.setdefault("done_steps", [])
+        data = dict(data)
+        if data.get("attach_file"):
+            data["attach_file"] = os.path.join(job_dir, data["attach_file"])
+        data["attach"], data["attach_type"] = self.get_publish_attachment(data)
+        try:
+            handler.publish_to_card(data)
+        finally:
+            if hasattr(data["attach"], "close"):
+                data["attach"].close()
+
+
     def get_publish_data(self, scene_file, publish_file, task_type):
         """
         Read export data needed for Trello from file names.
@@ -366,7 +518,7 @@ class Prism_PrismTrello_Functions(object):
             data["task"] = publish_split[-4]
             vinfo_path = os.path.normpath(os.path.join(publish_file, "..", "..", "versioninfo.yml"))
             # correct task_type - make more specific
-            task_type = next(t for t, subpath in self.trello_handler.task_paths.items()
+            task_type = next(t for t, subpath in trelloprism.TrelloHandler.task_paths.items()
                              if subpath in publish_file)
         else:
             raise ValueError("Unknown publish type.")
@@ -398,8 +550,9 @@ class Prism_PrismTrello_Functions(object):
             raise EnvironmentError("Can't find file in pipeline!")
 
         # get some stuff from version .ini
-        task_subpath = self.trello_handler.task_paths[data["type"]]
+        task_subpath = trelloprism.TrelloHandler.task_paths[data["type"]]
         data["task_path"] = os.path.join(base_path, task_subpath, data["task"])
+        data["entity_path"] = base_path
         # config_items = dict(self.core.getConfig(configPath=vinfo_path, getItems=True, cat="information"))
         config_items = dict(self.core.getConfig(configPath=vinfo_path, cat="information"))
 
@@ -416,47 +569,79 @@ class Prism_PrismTrello_Functions(object):
         """
         Get an attachment for the publish in requests-ready form
         :param data:
-        :return: bytesIO object (readable)
+        :return: readable file-like (an open file, or bytesIO) & its extension. caller closes it
         """
         # ffmpeg -framerate 24 -apply_trc iec61966_2_1 -i input.mp4 -c:v libvpx-vp9 -b:v 2M -fs 8000000 -pass 2 -y output.webm
+        if data.get("attach_file"):
+            # already grabbed (ie snapdraw) and saved with the queued publish.
+            # handed over open, so it's streamed up rather than read into memory
+            return open(data["attach_file"], "rb"), os.path.splitext(data["attach_file"])[-1].lstrip(os.extsep)
+
         # FIRST take care of VIDEO possibilities
         pub = data["publish_file"]
         # print(os.path.splitext(pub)[-1])
         # mp4 = pub.replace("..jpg", ".mp4")
-        mp4 = os.path.splitext(pub)[0].rstrip(os.extsep) + ".mp4"
+        mp4 = self.get_publish_mp4(data)
         if os.path.exists(mp4):
             # still convert for consistency and file size
-            return self.get_video_buffer(mp4), "webm"
+            video, data["poster"] = self.get_video_preview(mp4)
+            return video, "webm"
         # if os.path.splitext(pub)[-1] in (".mp4", ".mov", ".avi", ".webm"):
         #     return self.get_video_buffer(pub), "webm"
 
         # now guaranteed to be frame inputs
-        sf = "{:04d}".format(data["start_frame"])
         frame_input = ""
         if data["type"] == "Playblast":
             # get ffmpeg args - input file should be blahblah.{:04d}.ext
             # but leave start_frame for -start_number ffmpeg arg
             frame_input = pub.replace("..", ".%04d.")
-            return self.get_video_buffer(frame_input), "webm"
+            video, data["poster"] = self.get_video_preview(frame_input)
+            return video, "webm"
         elif data["type"] == "Render":
-            # current pub file is blahblah.exr
-            for f in os.listdir(os.path.dirname(pub)):
-                if ".{}.".format(sf) in f:
-                    ext = os.path.splitext(f)[1]
-                    frame_input = pub.replace(".exr", ".%04d{}".format(ext))
-
-            return self.get_video_buffer(frame_input, sf), "webm"
+            # current pub file is blahblah.exr - frames are blahblah.####.whatever
+            prefix = "{}.".format(os.path.splitext(os.path.basename(pub))[0])
+            seq = trellomedia.find_sequence(os.path.dirname(pub), prefix, data["start_frame"])
+            if not seq:
+                print("No rendered frames found for {}".format(pub))
+                return None, None
+            seq = seq.clip(data["start_frame"], data["end_frame"])
+            # full res exrs are slow to decode - a smaller preview does fine on Trello
+            video, data["poster"] = self.get_video_preview(seq, proxy=self.get_proxy_settings())
+            return video, "webm"
 
         # alright now what's left? playblast & render are taken care of
         # 2d & export are left.
         elif data["type"] == "2D":
-            with open(pub, "rb") as f:
-                buf = io.BytesIO(f.read())
             ext = os.path.splitext(pub)[-1].lstrip(os.extsep)
-            return buf, ext
+            return open(pub, "rb"), ext
+
+        return None, None
+
+
+    def get_publish_mp4(self, data):
+        """
+        :param data: publish data
+        :return: path of the mp4 which would sit next to the publish (may not exist)
+        """
+        return os.path.splitext(data["publish_file"])[0].rstrip(os.extsep) + ".mp4"
+
 
-        # at this point, what to attach is a bit of a toss-up.
-        # see if they want to attach a snapdraw, otherwise nothing
+    def needs_snapshot(self, data):
+        """
+        Whether there's nothing to attach for this publish without asking the user for a picture.
+        :param data: publish data
+        :return: bool
+        """
+        return data["type"] not in ("Playblast", "Render", "2D") and not os.path.exists(self.get_publish_mp4(data))
+
+
+    def get_snapshot_attachment(self, data):
+        """
+        What to attach is a bit of a toss-up - see if they want to attach a snapdraw.
+        Has to run on the main thread.
+        :param data: publish data
+        :return: bytesIO object & extension, or None, None
+        """
         if snapdraw:
             res = QMessageBox.question(None, "Publish Attachment",
                                        "No attachment found for export {}.\nWant to take a pretty picture?".format(data["task"]))
@@ -481,54 +666,183 @@ class Prism_PrismTrello_Functions(object):
         return None, None
 
 
-    def get_video_buffer(self, input_path, start_frame=None, maxSize=8000000, fmt="webm"):
+    def get_preview_cache(self):
         """
-        Take an image sequence and make it a webm of limited size.
-        :param input_path: start image/mp4 for ffmpeg frames to movie
-        :param start_frame: initial frame number
-        :param maxSize: HARD limit. could attempt a target size later but meh.
-        :param fmt: string format - extension without leading .
-        :return: byte buffer
-        """
-        ffmpegIsInstalled = False
-        if platform.system() == "Windows":
-            ffmpegPath = os.path.join(self.core.prismRoot, "Tools", "FFmpeg", "bin", "ffmpeg.exe")
-            if os.path.exists(ffmpegPath):
-                ffmpegIsInstalled = True
-        elif platform.system() == "Linux":
-            ffmpegPath = "ffmpeg"
+        Cache of encoded previews, shared by all projects - it's keyed by content, so they can't clash.
+        Size cap comes from the project's "preview_cache_mb" trello setting.
+        :return: trellomedia.PreviewCache
+        """
+        size = self.core.getConfig("trello", "preview_cache_mb", configPath=self.core.prismIni)
+        try:
+            max_bytes = int(size) * 1024 * 1024
+        except (TypeError, ValueError):
+            max_bytes = 1024 * 1024 * 1024
+        return trellomedia.PreviewCache(os.path.join(gettempdir(), "prismtrello_previews"), max_bytes)
+
+
+    def get_toolchain(self):
+        """
+        ffmpeg & friends, found and probed once per session. Results are kept in the temp dir
+        until the executables change.
+        :return: trellomedia.Toolchain
+        """
+        return trellomedia.Toolchain.get(self.core.prismRoot, os.path.join(gettempdir(), "prismtrello_toolchain.json"))
+
+
+    def start_webhooks(self):
+        """
+        Start the handler's webhook receiver if the project has a "webhook_port" trello setting.
+        It only listens on localhost. "webhook_url" is where Trello can reach it from outside (ie a tunnel),
+        and "webhook_secret" the app secret to check payloads with - a url without a secret is refused.
+        Runs on the connect thread, so it can't raise.
+        :return: trellohook.WebhookReceiver, or None
+        """
+        try:
+            port = int(self.core.getConfig("trello", "webhook_port", configPath=self.core.prismIni))
+        except (TypeError, ValueError):
+            return None
+        url = self.core.getConfig("trello", "webhook_url", configPath=self.core.prismIni) or None
+        secret = self.core.getConfig("trello", "webhook_secret", configPath=self.core.prismIni) or None
+        try:
+            return self.trello_handler.start_webhooks(port, url, secret)
+        except Exception:
+            print("Couldn't start Trello webhooks:")
+            traceback.print_exc()
+            return None
+
+
+    def get_proxy_settings(self):
+        """
+        :return: (max width, every nth frame) for render previews, from the project's
+        "proxy_width" & "proxy_step" trello settings. width 0 means full size
+        """
+        settings = []
+        for key, default in ("proxy_width", 1280), ("proxy_step", 1):
+            value = self.core.getConfig("trello", key, configPath=self.core.prismIni)
             try:
-                subprocess.Popen([ffmpegPath])
-                ffmpegIsInstalled = True
-            except:
-                pass
-        elif platform.system() == "Darwin":
-            ffmpegPath = os.path.join(self.core.prismRoot, "Tools", "ffmpeg")
-            if os.path.exists(ffmpegPath):
-                ffmpegIsInstalled = True
-        else:
-            ffmpegPath = ""
+                settings.append(max(0, int(value)))
+            except (TypeError, ValueError):
+                settings.append(default)
+        return tuple(settings)
+
+
+    def get_video_buffer(self, input_path, start_frame=None, maxSize=8000000, fmt="webm", stream=True, profile=None,
+                         proxy=None):
+        """
+        get_video_preview, without the poster.
+        :return: readable - the cached preview, ffmpeg being cached as it's read, or byte buffer
+        """
+        return self.get_video_preview(input_path, start_frame, maxSize, fmt, stream, profile, proxy)[0]
 
-        if not ffmpegIsInstalled:
-            QMessageBox.critical(self.core.messageParent, "Video conversion", "Could not find %s" % ffmpegPath)
-            return
 
-        args = [ffmpegPath]
-        if start_frame:
-            # this only happens for frame input, as those pass in start frame
-            # these args cause errors for video input
-            args.extend(["-framerate", "24",
-                         "-start_number", start_frame,])
-        args.extend(["-apply_trc", "iec61966_2_1",
-                     "-i", input_path,
-                     # "-c:v", "libvpx-vp9",
-                     "-b:v", "512k",
-                     "-f", fmt,
-                     "-pix_fmt", "yuva420p",
-                     "-fs", str(maxSize),
-                     "-"
-        ])
-
-        process = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        buf = io.BytesIO(process.communicate()[0])
-        return buf
+    def get_video_preview(self, input_path, start_frame=None, maxSize=8000000, fmt="webm", stream=True, profile=None,
+                          proxy=None):
+        """
+        Take an image sequence and make it a webm of limited size, plus a jpeg poster from the same encode.
+        :param input_path: start image/mp4 for ffmpeg frames to movie, or a trellomedia.FrameSequence
+        :param start_frame: initial frame number
+        :param maxSize: size cap. the bitrate's picked to fit the shot under it, -fs is only a backstop
+        :param fmt: string format - extension without leading .
+        :param stream: hand back the running ffmpeg to read from as it encodes,
+        so the upload overlaps the encode. otherwise wait for all of it
+        :param profile: trellomedia.EncoderProfile name - defaults to the project's "preview_profile" setting
+        :param proxy: optional (max width, every nth frame) to encode a lighter preview
+        :return: readable - the cached preview, ffmpeg being cached as it's read, or byte buffer.
+        and the poster's path - it's there once the video's been read to the end. None if there won't be one,
+        both None on failure
+        """
+        seq = None
+        if isinstance(input_path, trellomedia.FrameSequence):
+            seq = input_path
+        elif "%" in os.path.basename(input_path):
+            seq = trellomedia.FrameSequence.from_pattern(input_path)
+            if seq is not None:
+                seq = seq.clip(start_frame and int(start_frame))
+        if seq is not None:
+            if not seq:
+                print("Video conversion: no frames for {}".format(input_path))
+                return None, None
+            input_path = seq.pattern
+
+        tools = self.get_toolchain()
+        if not tools.ffmpeg:
+            if trelloqt.on_main_thread():
+                QMessageBox.critical(self.core.messageParent, "Video conversion", "Could not find ffmpeg")
+            else:
+                print("Video conversion: could not find ffmpeg")
+            return None, None
+        if os.path.splitext(input_path)[-1].lower() == ".exr" and not tools.can_decode("exr"):
+            print("Video conversion: {} can't read EXRs".format(tools.ffmpeg))
+            return None, None
+
+        fps = 24
+        width, step = proxy or (0, 1)
+        frame_count = None
+        encoded_frames = None
+        input_files = [input_path]
+        concat = None
+        input_args = []
+        if seq is not None:
+            frame_count = seq.last - seq.first + 1
+            frames = seq.frames[::step]
+            encoded_frames = len(frames)
+            input_files = [seq.path(f) for f in frames]
+            if step > 1 or seq.gaps():
+                # the pattern reader stops at the first gap and can't skip frames - so list them out.
+                # only the listed frames get decoded
+                concat = [seq.path(f) for f in frames]
+                input_args.extend(["-f", "concat", "-safe", "0"])
+            else:
+                input_args.extend(["-framerate", str(fps), "-start_number", str(seq.first)])
+        input_args.extend(["-apply_trc", "iec61966_2_1",
+                           "-i", "{concat}" if concat else input_path,
+                           "-an"])
+        if width:
+            # never scaled up, height kept even for the encoder
+            input_args.extend(["-vf", "scale='min({},iw)':-2".format(width)])
+        output_args = []
+        if encoded_frames:
+            # the pattern reader keeps going past the last frame if there are more on disk
+            output_args.extend(["-frames:v", str(encoded_frames)])
+        output_args += ["-f", fmt,
+                       "-pix_fmt", "yuva420p",
+                       "-fs", str(maxSize),
+                       "-"]
+        if profile is None:
+            profile = self.core.getConfig("trello", "preview_profile", configPath=self.core.prismIni)
+        profile = tools.profile(profile)
+
+        # same frames, same settings - same video. no need to encode it again.
+        # the bitrate follows from those, so it's left out (finding a video's length costs a process)
+        cache = self.get_preview_cache()
+        key = cache.key(input_files, input_args + profile.args(None, fps, maxSize, 1) + output_args)
+        poster = cache.path(key, "jpg")
+        video = cache.get(key, fmt)
+        if video:
+            print("Using cached preview of {}".format(input_path))
+            if not os.path.isfile(poster):
+                # cached by an ffmpeg that couldn't make one
+                poster = None
+        else:
+            if frame_count is None:
+                duration = tools.duration(input_path)
+                frame_count = int(duration * fps) if duration else None
+                encoded_frames = frame_count
+            temp_files = []
+            if concat:
+                temp_files.append(trellomedia.concat_list(concat, float(step) / fps))
+                input_args[input_args.index("{concat}")] = temp_files[0]
+            args = [tools.ffmpeg] + input_args + profile.args(frame_count, fps, maxSize, tools.threads) + output_args
+            if tools.can_encode("mjpeg") or not tools.encoders:
+                # a second output off the same decode - the poster costs next to nothing
+                args.extend(trellomedia.poster_args(trellomedia.part_path(poster), (encoded_frames or 0) // 2))
+            else:
+                poster = None
+            video = cache.store(key, fmt, trellomedia.FFmpegStream(args, temp_files), extras=["jpg"])
+
+        if stream:
+            return video, poster
+        try:
+            return io.BytesIO(video.read()), poster
+        finally:
+            video.close()
@@ -0,0 +1,157 @@
+import os, json, glob
+from tempfile import mkstemp
+from multiprocessing.pool import ThreadPool
+
+"""
+Writing the trello ids into entityinfo.ini/taskinfo.ini files without hammering the project share.
+Prism's config layer owns those files (their format & where they live), so everything still goes
+through core.getConfig/setConfig - but only keys whose value actually changes get set, and files go in parallel.
+Also home to the crash-safe file writing everything else saved to disk goes through.
+"""
+
+# read once - os.umask can only be read by setting it
+UMASK = os.umask(0)
+os.umask(UMASK)
+
+
+class ConfigWriter(object):
+    """
+    Collects config values for any number of files, then writes them all in one go with flush().
+    Files go in parallel, and values the files already have are left alone.
+    """
+    def __init__(self, core, workers=8):
+        """
+        :param core: Prism core, whose getConfig/setConfig do the reading & writing
+        :param workers: how many files can be written at once
+        """
+        self.core = core
+        self.workers = workers
+        # path : {section : {key : value}}
+        self.pending = {}
+
+
+    def __len__(self):
+        return len(self.pending)
+
+
+    def update(self, path, section, values):
+        """
+        :param path: config file
+        :param section: config section, ie "trello"
+        :param values: dict of option name : value
+        :return: None
+        """
+        sections = self.pending.setdefault(os.path.normpath(path), {})
+        sections.setdefault(section, {}).update(values)
+
+
+    def flush(self):
+        """
+        Write everything collected so far.
+        :return: list of the files which actually changed
+        """
+        pending, self.pending = self.pending, {}
+        if not pending:
+            return []
+        items = list(pending.items())
+        if len(items) == 1 or self.workers < 2:
+            results = [write_config(self.core, path, sections) for path, sections in items]
+        else:
+            pool = ThreadPool(min(self.workers, len(items)))
+            try:
+                results = pool.map(lambda item: write_config(self.core, *item), items)
+            finally:
+                pool.close()
+        return [path for (path, _), changed in zip(items, results) if changed]
+
+
+def write_config(core, path, sections):
+    """
+    Set values in a Prism config file, skipping any it already has.
+    :param core: Prism core
+    :param path: config file - its folder is made if it isn't there
+    :param sections: dict of section : {key : value}
+    :return: bool - whether anything had to be set
+    """
+    changed = False
+    for section, values in sections.items():
+        for key, value in values.items():
+            if core.getConfig(section, key, configPath=path) == value:
+                continue
+            if not changed:
+                folder = os.path.dirname(path)
+                if folder and not os.path.exists(folder):
+                    os.makedirs(folder)
+                changed = True
+            core.setConfig(section, key, value, configPath=path)
+    return changed
+
+
+def write_file(path, write_func):
+    """
+    Write a file so that a crash leaves either the old one or the new one, never half:
+    it's written to a temp file next to it, then swapped in. See read_json for reading it back.
+    Each write gets its own temp file, so processes saving the same file at once can't mix theirs up -
+    the last one to swap wins.
+    :param path: destination file
+    :param write_func: function taking the open (text) file to write into
+    :return: None
+    """
+    fd, tmp = mkstemp(prefix="{}.".format(os.path.basename(path)), suffix=".tmp",
+                      dir=os.path.dirname(path) or None)
+    try:
+        with os.fdopen(fd, "w") as f:
+            write_func(f)
+        # mkstemp makes it private to this user - give it the permissions a plain open would have
+        os.chmod(tmp, 0o666 & ~UMASK)
+        if hasattr(os, "replace"):
+            os.replace(tmp, path)
+        else:
+            # python 2 can't rename over a file on windows
+            if os.path.exists(path):
+                os.remove(path)
+            os.rename(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+
+def temp_copies(path):
+    """
+    :param path: file written by write_file
+    :return: list of temp files left next to it by crashed writes, newest first
+    """
+    def mtime(p):
+        try:
+            return os.path.getmtime(p)
+        except OSError:
+            return 0
+    return sorted(glob.glob("{}.*.tmp".format(glob.escape(path) if hasattr(glob, "escape") else path)),
+                  key=mtime, reverse=True)
+
+
+def write_json(path, obj, **kwargs):
+    """
+    :param path: destination file
+    :param obj: json-able object
+    :param kwargs: passed on to json.dump, ie indent
+    :return: None
+    """
+    write_file(path, lambda f: json.dump(obj, f, **kwargs))
+
+
+def read_json(path):
+    """
+    Read json written by write_json, falling back to the newest temp copy if a crash
+    happened between swapping the files.
+    :param path: json file
+    :return: the loaded object, or None if there's nothing good there
+    """
+    for p in [path] + temp_copies(path):
+        try:
+            with open(p) as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            continue
+    return None
@@ -0,0 +1,195 @@
+import os, subprocess, uuid, shutil, threading
+from tempfile import mkstemp
+
+"""
+HTTPS through the curl executable, for when Python's ssl can't do TLS 1.2.
+Fucking OSX. Fucking Maya.
+"""
+
+
+class CurlTransport(object):
+    """
+    Runs any number of requests through ONE curl process - the requests go in as a config on stdin,
+    separated by "next", so curl keeps the TLS connection open between them.
+    Responses come back through stdout, each followed by a boundary line with its status code.
+    """
+    def __init__(self, executable="curl"):
+        self.executable = executable
+
+
+    def send(self, method, url, files=None):
+        """
+        :param method: HTTP method of the request
+        :param url: the pre-encoded URL (thanks requests)
+        :param files: a dict of {"file": (name, contents or readable file-like)} or None
+        :return: status code & response content
+        """
+        return self.send_many([(method, url, files)])[0]
+
+
+    def send_many(self, requests):
+        """
+        Send a bunch of requests in order, over one connection.
+        :param requests: list of (method, url, files) - see send
+        :return: list of (status code, content), in the same order. code 0 means no response at all
+        """
+        if not requests:
+            return []
+
+        boundary = "--prismtrello-{}".format(uuid.uuid4().hex)
+        # after each response. the leading newline keeps it clear of the body
+        write_out = "\n{} %{{http_code}}\n".format(boundary)
+        config = []
+        temp_files = []
+        # one file-like body per curl process can come in on stdin
+        stdin_body = None
+        try:
+            for method, url, files in requests:
+                if config:
+                    config.append("next")
+                config.append("url = {}".format(quote(url)))
+                config.append("request = {}".format(quote(method)))
+                config.append("write-out = {}".format(quote(write_out)))
+                if files:
+                    name, body = files["file"]
+                    path = disk_path(body)
+                    if path:
+                        # it's already a file - curl can read it itself
+                        source = path
+                    elif hasattr(body, "read") and stdin_body is None:
+                        # stream it through stdin
+                        source, stdin_body = "-", body
+                    else:
+                        # requests takes files as name, binary string
+                        # but curl needs a filename - so make one
+                        fd, source = mkstemp(suffix=os.path.splitext(name)[-1])
+                        temp_files.append(source)
+                        with os.fdopen(fd, "wb") as of:
+                            if hasattr(body, "read"):
+                                shutil.copyfileobj(body, of)
+                            else:
+                                of.write(body)
+                    config.append("form = {}".format(quote("file=@{};filename={}".format(source, name))))
+
+            output = self._run("\n".join(config) + "\n", stdin_body)
+        finally:
+            for fn in temp_files:
+                os.remove(fn)
+
+        return parse_output(output, boundary.encode(), len(requests))
+
+
+    def _run(self, config, body=None):
+        """
+        Run curl with the given config.
+        :param config: string - curl config file contents
+        :param body: optional file-like to feed curl's stdin, in chunks.
+        the config then goes through a temp file instead of stdin
+        :return: bytes - everything curl wrote to stdout
+        """
+        startupinfo = None
+        if os.name == "nt":
+            startupinfo = subprocess.STARTUPINFO()
+            # set startup invisible flag
+            startupinfo.dwFlags |= subprocess.STARTF_USESHOWWINDOW
+        # exit code is only about the last transfer, so it's ignored - every request gets its own status
+        if body is None:
+            process = subprocess.Popen([self.executable, "--silent", "--config", "-"], startupinfo=startupinfo,
+                                       stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+            return process.communicate(config.encode("utf-8"))[0]
+
+        # it has the token in it - mkstemp makes it readable by this user only
+        fd, config_path = mkstemp(suffix=".curlrc")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(config.encode("utf-8"))
+            process = subprocess.Popen([self.executable, "--silent", "--config", config_path],
+                                       startupinfo=startupinfo, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+            errors = []
+            feeder = threading.Thread(target=feed, args=(body, process.stdin, process, errors))
+            feeder.daemon = True
+            feeder.start()
+            output = process.stdout.read()
+            process.wait()
+            feeder.join()
+        finally:
+            os.remove(config_path)
+        if errors:
+            # the body itself went wrong (ie its encode failed) - curl was stopped, don't pretend otherwise
+            raise errors[0]
+        return output
+
+
+def feed(source, pipe, process, errors, chunk_size=64 * 1024):
+    """
+    Copy a file-like into a pipe a chunk at a time, then close it.
+    :param source: readable file-like
+    :param pipe: writable pipe, ie a process' stdin
+    :param process: the process reading it - killed if source fails, so half a body isn't sent
+    :param errors: list to put source's exception in
+    :return: None
+    """
+    while True:
+        try:
+            chunk = source.read(chunk_size)
+        except Exception as e:
+            errors.append(e)
+            process.kill()
+            break
+        if not chunk:
+            break
+        try:
+            pipe.write(chunk)
+        except (IOError, OSError):
+            # curl went away - its output says what happened
+            break
+    try:
+        pipe.close()
+    except (IOError, OSError):
+        pass
+
+
+def disk_path(body):
+    """
+    :param body: upload body - bytes or file-like
+    :return: path of the file on disk if body is a regular file read from the start, otherwise None
+    """
+    name = getattr(body, "name", None)
+    try:
+        if isinstance(name, str) and os.path.isfile(name) and body.tell() == 0:
+            return name
+    except (AttributeError, IOError, OSError, ValueError):
+        pass
+    return None
+
+
+def quote(value):
+    """
+    :param value: string
+    :return: value double quoted & escaped for a curl config file
+    """
+    return '"{}"'.format(value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+
+
+def parse_output(output, boundary, count):
+    """
+    Split curl's stdout back into responses.
+    :param output: bytes - curl's stdout
+    :param boundary: bytes - boundary written after each response
+    :param count: number of requests sent
+    :return: list of (status code, content bytes). missing ones (curl died) get code 0
+    """
+    results = []
+    marker = b"\n" + boundary + b" "
+    pos = 0
+    while len(results) < count:
+        i = output.find(marker, pos)
+        if i < 0:
+            break
+        end = output.find(b"\n", i + len(marker))
+        code = output[i + len(marker):end if end >= 0 else len(output)]
+        results.append((int(code or 0), output[pos:i]))
+        pos = end + 1 if end >= 0 else len(output)
+
+    results.extend((0, b"") for _ in range(count - len(results)))
+    return results
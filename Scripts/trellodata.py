@@ -0,0 +1,435 @@
+"""
+In-memory model of the Trello team's data.
+Boards stay nested json (board["lists"], list["cards"], card["customFieldItems"])
+for anything that wants to walk them, but everything is also indexed by id.
+"""
+
+
+class TeamSnapshot(object):
+    """
+    Indexed copy of all boards on the team. Dicts keyed by board, list, card and custom field id
+    give O(1) lookups, and custom field option maps are only built once per board.
+    Boards & lists are also indexed by normalised name, for matching up with Prism's entities.
+    Indexing with a pipe name (snapshot["assets"]) gives that sector's list of boards.
+    """
+    # board background color decides which sector the board goes in
+    sector_colors = {"purple": "assets",
+                     "orange": "shots"}
+    # actions which change nothing the snapshot keeps track of
+    passive_actions = ("commentCard", "updateComment", "deleteComment",
+                       "addMemberToCard", "removeMemberFromCard", "addLabelToCard", "removeLabelFromCard",
+                       "addChecklistToCard", "removeChecklistFromCard", "updateCheckItemStateOnCard",
+                       "createCheckItem", "updateCheckItem", "deleteCheckItem", "updateChecklist")
+
+    def __init__(self, name_key=None):
+        """
+        :param name_key: function normalising a name for comparing, ie Prism validation + lowercase.
+        defaults to lowercase
+        """
+        self.name_key = name_key or (lambda name: name.lower())
+        self.boards = {}
+        self.lists = {}
+        self.cards = {}
+        self.fields = {}
+        # custom field id : {option id: option value}
+        self.options = {}
+        self.sectors = {"assets": [], "shots": [], "other": []}
+        # sector : {board key : board}, and board id : {list key : list}
+        self.board_names = dict((sector, {}) for sector in self.sectors)
+        self.list_names = {}
+
+
+    def __getitem__(self, pipe):
+        return self.sectors[pipe]
+
+
+    def __contains__(self, board_id):
+        return board_id in self.boards
+
+
+    @classmethod
+    def sector(cls, board):
+        """
+        :param board: board json
+        :return: "assets", "shots" or "other"
+        """
+        return cls.sector_colors.get(board["prefs"]["background"], "other")
+
+
+    def board_key(self, name):
+        """
+        :param name: Trello board name, with any subcategories joined by "/"
+        :return: normalised name, comparable to a Prism category
+        """
+        return "/".join(self.name_key(c) for c in name.split("/"))
+
+
+    def find_board(self, pipe, key):
+        """
+        :param pipe: sector - "assets" or "shots"
+        :param key: normalised board name, see board_key
+        :return: board json, or None
+        """
+        return self.board_names[pipe].get(key)
+
+
+    def find_list(self, board_id, key):
+        """
+        :param board_id: board the list is on
+        :param key: normalised list name, see name_key
+        :return: list json, or None
+        """
+        return self.list_names.get(board_id, {}).get(key)
+
+
+    def _index_board(self, board):
+        # boards sharing a name - first one in wins
+        self.board_names[self.sector(board)].setdefault(self.board_key(board["name"]), board)
+
+
+    def _unindex_board(self, board):
+        names = self.board_names[self.sector(board)]
+        key = self.board_key(board["name"])
+        if names.get(key) is board:
+            del names[key]
+            # another board with the same name can step up
+            for other in self.sectors[self.sector(board)]:
+                if other is not board and self.board_key(other["name"]) == key:
+                    names[key] = other
+                    break
+
+
+    def set_board(self, board, lists, fields, cards):
+        """
+        Put a board (and everything on it) into the snapshot, replacing whatever was there.
+        :param board: board json, top level info
+        :param lists: list of the board's open list json
+        :param fields: list of the board's custom field definitions
+        :param cards: list of the board's open card json, with customFieldItems & attachments
+        :return: the nested board json
+        """
+        if board["id"] in self.boards:
+            self.remove_board(board["id"])
+
+        board["lists"] = []
+        board["customFields"] = fields
+        self.boards[board["id"]] = board
+        self.sectors[self.sector(board)].append(board)
+        self._index_board(board)
+        self.list_names[board["id"]] = {}
+
+        for cf in fields:
+            self.fields[cf["id"]] = cf
+            if cf["type"] == "list":
+                self.options[cf["id"]] = dict((o["id"], o["value"]) for o in cf["options"])
+        for l in lists:
+            self.add_list(l)
+        for c in cards:
+            self.add_card(c)
+
+        return board
+
+
+    def update_board(self, board):
+        """
+        Refresh the top level info of a board already in the snapshot (name, prefs, activity).
+        :param board: board json without lists, cards or customFields
+        :return: None
+        """
+        old = self.boards[board["id"]]
+        sector = self.sector(old)
+        self._unindex_board(old)
+        old.update(board)
+        if self.sector(old) != sector:
+            self.sectors[sector].remove(old)
+            self.sectors[self.sector(old)].append(old)
+        self._index_board(old)
+
+
+    def remove_board(self, board_id):
+        """
+        Drop a board and everything on it.
+        :param board_id: id of board to remove
+        :return: None
+        """
+        board = self.boards.pop(board_id)
+        self.sectors[self.sector(board)].remove(board)
+        self._unindex_board(board)
+        self.list_names.pop(board_id, None)
+        for l in board["lists"]:
+            del self.lists[l["id"]]
+            for c in l["cards"]:
+                del self.cards[c["id"]]
+        for cf in board["customFields"]:
+            self.fields.pop(cf["id"], None)
+            self.options.pop(cf["id"], None)
+
+
+    def order(self, board_ids):
+        """
+        Sort the sectors to match the given board order (ie the order Trello gives them in).
+        :param board_ids: list of board ids
+        :return: None
+        """
+        rank = dict((b, i) for i, b in enumerate(board_ids))
+        for boards in self.sectors.values():
+            boards.sort(key=lambda b: rank.get(b["id"], len(rank)))
+
+
+    def add_list(self, trello_list):
+        """
+        Add a list to its board.
+        :param trello_list: list json
+        :return: the list json, now with a "cards" key
+        """
+        trello_list["cards"] = []
+        self.lists[trello_list["id"]] = trello_list
+        self.boards[trello_list["idBoard"]]["lists"].append(trello_list)
+        self.list_names[trello_list["idBoard"]].setdefault(self.name_key(trello_list["name"]), trello_list)
+        return trello_list
+
+
+    def remove_list(self, list_id):
+        """
+        Take a list (and its cards) off its board, if it's in the snapshot.
+        :param list_id: id of list to remove
+        :return: None
+        """
+        l = self.lists.pop(list_id, None)
+        if not l:
+            return
+        board = self.boards[l["idBoard"]]
+        board["lists"] = [other for other in board["lists"] if other["id"] != list_id]
+        names = self.list_names[l["idBoard"]]
+        key = self.name_key(l["name"])
+        if names.get(key) is l:
+            del names[key]
+            other = next((other for other in board["lists"] if self.name_key(other["name"]) == key), None)
+            if other:
+                names[key] = other
+        for c in l["cards"]:
+            del self.cards[c["id"]]
+
+
+    def add_card(self, card):
+        """
+        Name the card's custom field items and put it in its list.
+        If it's already in the snapshot, it's replaced.
+        :param card: card json, with customFieldItems & attachments
+        :return: bool, whether the card's list was found
+        """
+        self.remove_card(card["id"])
+        l = self.lists.get(card["idList"])
+        if l is None:
+            return False
+
+        for cf in card["customFieldItems"]:
+            cf_def = self.fields.get(cf["idCustomField"])
+            if cf_def:
+                # assign name and list value if necessary
+                cf["name"] = cf_def["name"]
+                if cf_def["type"] == "list":
+                    cf["value_dict"] = self.options[cf_def["id"]]
+
+        l["cards"].append(card)
+        self.cards[card["id"]] = card
+        return True
+
+
+    def remove_card(self, card_id):
+        """
+        Take a card out of its list, if it's in the snapshot.
+        :param card_id: id of card to remove
+        :return: None
+        """
+        card = self.cards.pop(card_id, None)
+        if card:
+            l = self.lists[card["idList"]]
+            l["cards"] = [c for c in l["cards"] if c["id"] != card_id]
+
+
+    def mark_activity(self, board_id, date):
+        """
+        Note that an action on a board was applied, ie from a webhook.
+        It's kept apart from dateLastActivity - that's the watermark refreshes fetch changes since,
+        and a webhook that never arrived would be skipped over if applied ones moved it.
+        :param board_id: board the action was on
+        :param date: ISO date string of the action
+        :return: None
+        """
+        board = self.boards.get(board_id)
+        # ISO dates sort as strings
+        if board and date and date > board.get("hookActivity", ""):
+            board["hookActivity"] = date
+
+
+    def apply_action(self, action):
+        """
+        Play a Trello action (ie one pushed to a webhook) onto the snapshot.
+        Only actions whose payload carries everything needed are handled here -
+        a new card, for instance, comes without its custom fields, so that's left to the caller.
+        :param action: action json
+        :return: bool - whether the snapshot now reflects the action
+        """
+        data = action["data"]
+        board_id = data.get("board", {}).get("id")
+        if board_id not in self.boards:
+            # nothing of it to keep current - it'll be fetched whole when it's needed
+            return True
+
+        if action["type"] in self.passive_actions:
+            applied = True
+        else:
+            apply_func = getattr(self, "_apply_{}".format(action["type"]), None)
+            applied = apply_func is not None and apply_func(board_id, data)
+        if applied:
+            self.mark_activity(board_id, action.get("date"))
+        return applied
+
+
+    # appliers for apply_action - each takes (board id, action data) and returns whether it managed
+
+    def _apply_updateCard(self, board_id, data):
+        card = self.cards.get(data["card"]["id"])
+        if card is None:
+            return False
+        if data["card"].get("closed"):
+            self.remove_card(card["id"])
+            return True
+        # the payload has the new value of everything that changed, and the old value in "old"
+        old_list = card["idList"]
+        for key in data.get("old", {}):
+            if key in data["card"]:
+                card[key] = data["card"][key]
+        if card["idList"] != old_list:
+            # moved - take it out of the old list by hand, remove_card would look in the new one
+            l = self.lists[old_list]
+            l["cards"] = [c for c in l["cards"] if c is not card]
+            del self.cards[card["id"]]
+            return self.add_card(card)
+        return True
+
+
+    def _apply_deleteCard(self, board_id, data):
+        self.remove_card(data["card"]["id"])
+        return True
+
+    _apply_moveCardFromBoard = _apply_deleteCard
+
+
+    def _apply_addAttachmentToCard(self, board_id, data):
+        card = self.cards.get(data["card"]["id"])
+        if card is None:
+            return False
+        attachment = data["attachment"]
+        card["attachments"] = [a for a in card["attachments"] if a["id"] != attachment["id"]]
+        card["attachments"].append(dict(attachment))
+        return True
+
+
+    def _apply_deleteAttachmentFromCard(self, board_id, data):
+        card = self.cards.get(data["card"]["id"])
+        if card is None:
+            return False
+        card["attachments"] = [a for a in card["attachments"] if a["id"] != data["attachment"]["id"]]
+        return True
+
+
+    def _apply_updateCustomFieldItem(self, board_id, data):
+        card = self.cards.get(data["card"]["id"])
+        item = data.get("customFieldItem")
+        if card is None or not item or item["idCustomField"] not in self.fields:
+            return False
+        items = [cf for cf in card["customFieldItems"] if cf["idCustomField"] != item["idCustomField"]]
+        # cleared fields just disappear from the card
+        if item.get("idValue") or item.get("value"):
+            item = dict(item)
+            cf_def = self.fields[item["idCustomField"]]
+            item["name"] = cf_def["name"]
+            if cf_def["type"] == "list":
+                item["value_dict"] = self.options[cf_def["id"]]
+            items.append(item)
+        card["customFieldItems"] = items
+        return True
+
+
+    def _apply_createList(self, board_id, data):
+        if data["list"]["id"] not in self.lists:
+            self.add_list(dict(data["list"], idBoard=board_id, closed=False))
+        return True
+
+
+    def _apply_updateList(self, board_id, data):
+        l = self.lists.get(data["list"]["id"])
+        if l is None:
+            return False
+        if data["list"].get("closed"):
+            self.remove_list(l["id"])
+            return True
+        changed = dict((key, data["list"][key]) for key in data.get("old", {}) if key in data["list"])
+        if "name" in changed:
+            # re-index under the new name
+            cards = l["cards"]
+            self.remove_list(l["id"])
+            l.update(changed)
+            self.add_list(l)
+            for c in cards:
+                self.add_card(c)
+        else:
+            l.update(changed)
+        if "pos" in changed:
+            self.boards[board_id]["lists"].sort(key=lambda other: other.get("pos", 0))
+        return True
+
+
+    def _apply_moveListFromBoard(self, board_id, data):
+        self.remove_list(data["list"]["id"])
+        return True
+
+
+    def _apply_updateBoard(self, board_id, data):
+        if data["board"].get("closed"):
+            self.remove_board(board_id)
+            return True
+        changed = dict((key, data["board"][key]) for key in data.get("old", {}) if key in data["board"])
+        if "prefs" in changed:
+            # only the prefs that changed come through
+            changed["prefs"] = dict(self.boards[board_id]["prefs"], **changed["prefs"])
+        changed["id"] = board_id
+        self.update_board(changed)
+        return True
+
+
+    def to_json(self):
+        """
+        :return: json-able list of boards, with lists & cards flattened out
+        """
+        boards = []
+        for b in self.boards.values():
+            b = dict(b)
+            b["cards"] = []
+            lists = b["lists"]
+            b["lists"] = []
+            for l in lists:
+                # option maps are shared by reference, no need to write them out per card
+                b["cards"].extend(dict(c, customFieldItems=[
+                    dict((k, v) for k, v in cf.items() if k != "value_dict") for cf in c["customFieldItems"]
+                ]) for c in l["cards"])
+                b["lists"].append(dict((k, v) for k, v in l.items() if k != "cards"))
+            boards.append(b)
+        return boards
+
+
+    @classmethod
+    def from_json(cls, boards, name_key=None):
+        """
+        Rebuild a snapshot (and its indexes) from the output of to_json.
+        :param boards: list of boards, as made by to_json
+        :param name_key: see __init__
+        :return: TeamSnapshot
+        """
+        snapshot = cls(name_key)
+        for b in boards:
+            lists, fields, cards = b.pop("lists"), b.pop("customFields"), b.pop("cards")
+            snapshot.set_board(b, lists, fields, cards)
+        return snapshot
@@ -0,0 +1,186 @@
+import hmac, json, base64, hashlib, threading, traceback, time
+import requests
+try:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+
+"""
+Local receiver for Trello webhooks, so board changes come to us instead of being polled for.
+Trello has to be able to reach it (ie through a tunnel or a forwarding server) - for trying
+it out, replay() plays saved webhook payloads at it the same way Trello would.
+"""
+
+
+class WebhookReceiver(object):
+    """
+    Small HTTP server on a background thread. Every action POSTed to it goes to the callback,
+    one at a time. HEAD gets a 200, which is all Trello checks when a webhook is registered.
+    """
+    def __init__(self, callback, port=0, host="127.0.0.1", secret=None, callback_url=None):
+        """
+        :param callback: function taking the action json of each webhook. called on a server thread
+        :param port: port to listen on. 0 picks a free one
+        :param host: interface to listen on. only this machine by default - a tunnel forwards to localhost.
+        "" is all of them, which lets anyone on the network rewrite the snapshot unless there's a secret
+        :param secret: Trello app secret - if given, payloads must be signed with it.
+        required with a callback_url, since then the receiver is reachable from outside
+        :param callback_url: the url the webhooks were registered with. needed to check signatures
+        """
+        if callback_url and not secret:
+            raise ValueError("A webhook secret is needed to receive webhooks from {}".format(callback_url))
+        self.callback = callback
+        self.host = host
+        self.port = port
+        self.secret = secret
+        self.callback_url = callback_url
+        self.server = None
+        self.thread = None
+        # actions are applied in the order they arrive, even though requests are handled in parallel
+        self.callback_lock = threading.Lock()
+        self.received = 0
+        self.last_received = None
+
+
+    @property
+    def running(self):
+        return self.thread is not None and self.thread.is_alive()
+
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:{}/".format(self.port)
+
+
+    def start(self):
+        """
+        Start listening, if it isn't already.
+        :return: int - the port it's listening on
+        """
+        if self.running:
+            return self.port
+        self.server = WebhookServer((self.host, self.port), WebhookRequestHandler)
+        self.server.receiver = self
+        self.port = self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever, name="PrismTrelloWebhooks")
+        self.thread.daemon = True
+        self.thread.start()
+        return self.port
+
+
+    def stop(self):
+        """
+        Stop listening and free the port.
+        :return: None
+        """
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+        if self.thread:
+            self.thread.join()
+        self.server = self.thread = None
+
+
+    def handle(self, body, signature=None):
+        """
+        Check and hand over one webhook payload.
+        :param body: bytes - the raw request body
+        :param signature: value of the X-Trello-Webhook header
+        :return: int - the http status to answer with
+        """
+        if self.secret and not hmac.compare_digest(
+                sign(self.secret, body, self.callback_url).encode("utf-8"), (signature or "").encode("utf-8")):
+            return 401
+        try:
+            action = json.loads(body.decode("utf-8"))["action"]
+        except (ValueError, KeyError, TypeError):
+            return 400
+
+        with self.callback_lock:
+            self.received += 1
+            self.last_received = time.time()
+            try:
+                self.callback(action)
+            except Exception:
+                # Trello tries again on anything but a 2xx
+                traceback.print_exc()
+                return 500
+        return 200
+
+
+class WebhookServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class WebhookRequestHandler(BaseHTTPRequestHandler):
+    def do_HEAD(self):
+        self.respond(200)
+
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        self.respond(self.server.receiver.handle(body, self.headers.get("X-Trello-Webhook")))
+
+
+    def respond(self, code):
+        self.send_response(code)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+
+    def log_message(self, format, *args):
+        # one line per action on the console is just noise
+        pass
+
+
+def sign(secret, body, callback_url):
+    """
+    Trello's webhook signature - base64 of the HMAC-SHA1 of the body followed by the callback url.
+    :param secret: Trello app secret
+    :param body: bytes - request body
+    :param callback_url: url the webhook was registered with
+    :return: string
+    """
+    digest = hmac.new(secret.encode("utf-8"), body + (callback_url or "").encode("utf-8"), hashlib.sha1).digest()
+    return base64.b64encode(digest).decode("ascii")
+
+
+def load_payloads(path):
+    """
+    Read saved webhook payloads - either a json list, or one json payload per line.
+    :param path: file path
+    :return: list of payload dicts, each with an "action"
+    """
+    with open(path) as f:
+        text = f.read().strip()
+    if text.startswith("["):
+        return json.loads(text)
+    return [json.loads(line) for line in text.splitlines() if line.strip()]
+
+
+def replay(url, payloads, secret=None, callback_url=None, delay=0.0):
+    """
+    Stand in for Trello - POST webhook payloads to a receiver, in order.
+    :param url: where the receiver is listening
+    :param payloads: list of payload dicts (see load_payloads), or bare action dicts
+    :param secret: optional Trello app secret to sign them with
+    :param callback_url: url to sign them for, if it isn't url (ie the receiver's behind a tunnel)
+    :param delay: seconds between payloads
+    :return: list of the http status of each
+    """
+    codes = []
+    with requests.session() as session:
+        for i, payload in enumerate(payloads):
+            if i and delay:
+                time.sleep(delay)
+            if "action" not in payload:
+                payload = {"action": payload}
+            body = json.dumps(payload).encode("utf-8")
+            headers = {"Content-Type": "application/json"}
+            if secret:
+                headers["X-Trello-Webhook"] = sign(secret, body, callback_url or url)
+            codes.append(session.post(url, data=body, headers=headers).status_code)
+    return codes
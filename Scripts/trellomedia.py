@@ -0,0 +1,690 @@
+import os, re, sys, json, time, hashlib, platform, subprocess, threading, multiprocessing
+from collections import deque
+from tempfile import mkstemp
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+"""
+Making previews of publishes for Trello - running ffmpeg & handing over what it makes.
+"""
+
+
+class EncodeError(Exception):
+    # ffmpeg fell over. message has the end of its log
+    pass
+
+
+class FFmpegStream(object):
+    """
+    A running ffmpeg, read like a file. Its stdout is handed out as it's encoded,
+    so the upload goes on while ffmpeg is still working - and nothing is held in memory.
+    Stderr is drained in the background into a log of the last few lines,
+    so a chatty ffmpeg can't fill the pipe (and hang) or eat memory.
+    """
+    # lines of ffmpeg's stderr kept around
+    log_lines = 100
+
+    def __init__(self, args, temp_files=()):
+        """
+        :param args: ffmpeg command line, writing its output to stdout ("-")
+        :param temp_files: files only needed for this encode (ie a concat list), deleted on close
+        """
+        self.args = args
+        self.temp_files = list(temp_files)
+        self.log = deque(maxlen=self.log_lines)
+        self.size = 0
+        self.process = subprocess.Popen(args, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                        stderr=subprocess.PIPE)
+        # nothing to say to it
+        self.process.stdin.close()
+        self.log_thread = threading.Thread(target=drain, args=(self.process.stderr, self.log))
+        self.log_thread.daemon = True
+        self.log_thread.start()
+
+
+    def read(self, size=-1):
+        """
+        :param size: max bytes to read, or -1 for everything until ffmpeg's done
+        :return: bytes - empty once ffmpeg has finished successfully
+        """
+        data = self.process.stdout.read(-1 if size is None else size)
+        self.size += len(data)
+        if not data and size != 0:
+            self.finish()
+        return data
+
+
+    def finish(self):
+        """
+        Wait for ffmpeg to exit, making sure it actually made something.
+        Raised from read, this stops the upload before Trello gets half a video.
+        :return: None
+        """
+        code = self.process.wait()
+        self.log_thread.join()
+        if code != 0 or not self.size:
+            raise EncodeError("ffmpeg exited with code {} after {} bytes:\n{}".format(
+                code, self.size, "\n".join(list(self.log)[-10:])))
+
+
+    def close(self):
+        """
+        Done with it - kills ffmpeg if it's still going (ie the upload failed).
+        :return: None
+        """
+        if self.process.poll() is None:
+            self.process.kill()
+        self.process.wait()
+        self.process.stdout.close()
+        self.log_thread.join()
+        for fn in self.temp_files:
+            try:
+                os.remove(fn)
+            except OSError:
+                pass
+        self.temp_files = []
+
+
+class Toolchain(object):
+    """
+    Where ffmpeg & ffprobe are and what they can do - found once per session, not per publish.
+    The probe results are saved to disk along with the size & mtime of the executables,
+    so later sessions only re-run them if ffmpeg has been swapped out.
+    """
+    # prism root : Toolchain, for this session
+    found = {}
+    lock = threading.Lock()
+
+    def __init__(self, ffmpeg=None, ffprobe=None, encoders=(), decoders=(), threads=1):
+        self.ffmpeg = ffmpeg
+        self.ffprobe = ffprobe
+        self.encoders = set(encoders)
+        self.decoders = set(decoders)
+        self.threads = threads
+
+
+    @classmethod
+    def get(cls, prism_root, cache_path=None):
+        """
+        :param prism_root: Prism's install folder, which may have ffmpeg bundled
+        :param cache_path: json file to keep probe results in between sessions
+        :return: Toolchain - its ffmpeg is None if there isn't one
+        """
+        with cls.lock:
+            if prism_root not in cls.found:
+                cls.found[prism_root] = cls.probe(prism_root, cache_path)
+            return cls.found[prism_root]
+
+
+    @classmethod
+    def probe(cls, prism_root, cache_path=None):
+        """
+        Find the executables & ask ffmpeg what it supports, unless the saved results are still good.
+        :return: Toolchain
+        """
+        ffmpeg = find_executable("ffmpeg", prism_root)
+        ffprobe = find_executable("ffprobe", prism_root)
+        key = [platform.system(), sys.version_info[0]]
+        for exe in (ffmpeg, ffprobe):
+            st = os.stat(exe) if exe else None
+            key.append([exe, st.st_size, st.st_mtime] if st else None)
+
+        saved = None
+        if cache_path:
+            try:
+                with open(cache_path) as f:
+                    saved = json.load(f)
+            except (IOError, OSError, ValueError):
+                pass
+        if saved and saved.get("key") == key:
+            return cls(ffmpeg, ffprobe, saved["encoders"], saved["decoders"], saved["threads"])
+
+        encoders, decoders = [], []
+        if ffmpeg:
+            encoders = codec_list(ffmpeg, "-encoders")
+            decoders = codec_list(ffmpeg, "-decoders")
+        tools = cls(ffmpeg, ffprobe, encoders, decoders, cpu_count())
+        if cache_path:
+            try:
+                with open(cache_path, "w") as f:
+                    json.dump({"key": key, "encoders": encoders, "decoders": decoders,
+                               "threads": tools.threads}, f)
+            except (IOError, OSError):
+                pass
+        return tools
+
+
+    def can_encode(self, codec):
+        return codec in self.encoders
+
+
+    def can_decode(self, codec):
+        return codec in self.decoders
+
+
+    def profile(self, name=None):
+        """
+        :param name: EncoderProfile name
+        :return: that EncoderProfile, or one this ffmpeg can actually do if it can't
+        """
+        profile = EncoderProfile.get(name)
+        if not self.encoders or self.can_encode(profile.codec):
+            return profile
+        for p in sorted(EncoderProfile.profiles.values(), key=lambda p: p.name != EncoderProfile.default):
+            if self.can_encode(p.codec):
+                return p
+        return profile
+
+
+    def duration(self, path):
+        """
+        :param path: a video file
+        :return: float - its length in seconds, or None if ffprobe isn't there or can't tell
+        """
+        if not self.ffprobe:
+            return None
+        try:
+            out = subprocess.check_output([self.ffprobe, "-v", "error", "-show_entries", "format=duration",
+                                           "-of", "default=noprint_wrappers=1:nokey=1", path])
+            return float(out.strip())
+        except (subprocess.CalledProcessError, OSError, ValueError):
+            return None
+
+
+class EncoderProfile(object):
+    """
+    Named set of libvpx settings for encoding previews. Instead of a fixed bitrate cut off by -fs,
+    the bitrate is worked out from the length of the shot so the whole thing fits under the size cap.
+    """
+    # name : EncoderProfile
+    profiles = {}
+    default = "balanced"
+    # -fs is still there as a backstop, so aim a bit under it for container overhead & VBR wobble
+    size_margin = 0.85
+
+    def __init__(self, name, codec="libvpx-vp9", speed=4, deadline="good", row_mt=True, tile_columns=2,
+                 max_bitrate=4000000, fallback_bitrate=512000):
+        """
+        :param name: what it's called in settings
+        :param codec: ffmpeg video encoder
+        :param speed: libvpx -cpu-used. higher is faster & worse
+        :param deadline: libvpx -deadline - "realtime", "good" or "best"
+        :param row_mt: use VP9 row based multithreading
+        :param tile_columns: log2 of VP9 tile columns - more tiles, more threads can work at once
+        :param max_bitrate: never go above this, however short the shot
+        :param fallback_bitrate: used when the length isn't known
+        """
+        self.name = name
+        self.codec = codec
+        self.speed = speed
+        self.deadline = deadline
+        self.row_mt = row_mt
+        self.tile_columns = tile_columns
+        self.max_bitrate = max_bitrate
+        self.fallback_bitrate = fallback_bitrate
+        EncoderProfile.profiles[name] = self
+
+
+    @classmethod
+    def get(cls, name=None):
+        """
+        :param name: profile name. unknown or None gives the default
+        :return: EncoderProfile
+        """
+        return cls.profiles.get(name) or cls.profiles[cls.default]
+
+
+    def bitrate(self, frame_count, fps, max_size):
+        """
+        :param frame_count: number of frames, or None if it isn't known
+        :param fps: frames per second
+        :param max_size: size cap of the output, in bytes
+        :return: int - target bits per second
+        """
+        if not frame_count or not fps:
+            return self.fallback_bitrate
+        seconds = float(frame_count) / fps
+        return int(min(self.max_bitrate, max_size * 8 * self.size_margin / seconds))
+
+
+    def args(self, frame_count, fps, max_size, threads=None):
+        """
+        :param frame_count: number of frames, or None if it isn't known
+        :param fps: frames per second
+        :param max_size: size cap of the output, in bytes
+        :param threads: encoder threads - defaults to the number of cpus
+        :return: list of ffmpeg output args for the video stream
+        """
+        threads = threads or cpu_count()
+        args = ["-c:v", self.codec,
+                "-b:v", str(self.bitrate(frame_count, fps, max_size)),
+                "-deadline", self.deadline,
+                "-cpu-used", str(self.speed),
+                "-threads", str(threads)]
+        if self.codec == "libvpx-vp9":
+            args.extend(["-row-mt", "1" if self.row_mt else "0",
+                         "-tile-columns", str(self.tile_columns)])
+        return args
+
+
+EncoderProfile("fast", codec="libvpx", speed=8, deadline="realtime", row_mt=False, tile_columns=0)
+EncoderProfile("balanced", speed=5)
+EncoderProfile("quality", speed=2, tile_columns=1)
+
+
+class PreviewCache(object):
+    """
+    Encoded previews kept on disk, keyed by a hash of what went into them - the input files'
+    paths, sizes & mtimes plus the encode args. So re-publishing the same playblast,
+    or retrying a failed upload, doesn't run ffmpeg again.
+    Least recently used previews go first once it's over max_bytes.
+    """
+    def __init__(self, root, max_bytes=1024 * 1024 * 1024):
+        """
+        :param root: folder to keep the previews in
+        :param max_bytes: size cap of the whole cache
+        """
+        self.root = root
+        self.max_bytes = max_bytes
+        if not os.path.exists(root):
+            os.makedirs(root)
+
+
+    def key(self, input_files, args):
+        """
+        :param input_files: list of paths ffmpeg will read
+        :param args: encode args (without the ffmpeg executable, which doesn't change the output)
+        :return: string - hex digest naming the preview
+        """
+        inputs = []
+        for path in sorted(input_files):
+            st = os.stat(path)
+            inputs.append([os.path.normcase(os.path.abspath(path)), st.st_size, st.st_mtime])
+        blob = json.dumps([inputs, [str(a) for a in args]])
+        return hashlib.sha1(blob.encode("utf-8")).hexdigest()
+
+
+    def path(self, key, ext):
+        return os.path.join(self.root, "{}.{}".format(key, ext))
+
+
+    def get(self, key, ext):
+        """
+        :param key: from key()
+        :param ext: extension of the preview
+        :return: the cached preview opened for reading, or None if there isn't one
+        """
+        path = self.path(key, ext)
+        try:
+            f = open(path, "rb")
+        except (IOError, OSError):
+            return None
+        # mtime is the "last used" for eviction
+        for fn in os.listdir(self.root):
+            if fn.startswith(key):
+                try:
+                    os.utime(os.path.join(self.root, fn), None)
+                except OSError:
+                    pass
+        return f
+
+
+    def store(self, key, ext, source, extras=()):
+        """
+        :param key: from key()
+        :param ext: extension of the preview
+        :param source: readable preview being made, ie an FFmpegStream
+        :param extras: extensions of other files source writes to their part_path() as it goes
+        (ie a poster frame). they're kept along with the preview
+        :return: readable which passes source through, saving it to the cache on the way.
+        only makes it in if it's read to the end
+        """
+        return CacheWriter(self, self.path(key, ext), source, [self.path(key, e) for e in extras])
+
+
+    def evict(self):
+        """
+        Delete least recently used previews until the cache fits in max_bytes.
+        :return: None
+        """
+        entries = []
+        for fn in os.listdir(self.root):
+            path = os.path.join(self.root, fn)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            # leftovers from writes that died long ago go too. fresh ones might still be going
+            if fn.endswith(".part") and time.time() - st.st_mtime < 24 * 3600:
+                continue
+            entries.append((fn.endswith(".part"), st.st_mtime, st.st_size, path))
+
+        total = sum(e[2] for e in entries)
+        for dead, mtime, size, path in sorted(entries, key=lambda e: (not e[0], e[1])):
+            if not dead and total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                pass
+
+
+class CacheWriter(object):
+    """
+    Reads through to a source, copying everything into a PreviewCache file as it goes.
+    """
+    def __init__(self, cache, path, source, extras=()):
+        self.cache = cache
+        self.path = path
+        self.source = source
+        self.extras = list(extras)
+        self.part = part_path(path)
+        self.file = open(self.part, "wb")
+
+
+    def read(self, size=-1):
+        data = self.source.read(size)
+        if self.file:
+            if data:
+                self.file.write(data)
+            elif size != 0:
+                # source raises if it went wrong, so this is the whole thing
+                self._commit()
+        return data
+
+
+    def _commit(self):
+        self.file.close()
+        self.file = None
+        for path in [self.path] + self.extras:
+            part = part_path(path)
+            if not os.path.exists(part):
+                continue
+            if os.path.exists(path):
+                # someone beat us to it - same key, same preview
+                os.remove(part)
+            else:
+                os.rename(part, path)
+        self.cache.evict()
+
+
+    def close(self):
+        if self.file:
+            # never finished, so it's no good to anyone
+            self.file.close()
+            self.file = None
+            for path in [self.path] + self.extras:
+                if os.path.exists(part_path(path)):
+                    os.remove(part_path(path))
+        self.source.close()
+
+
+def part_path(path):
+    """
+    :param path: a file going into a PreviewCache
+    :return: where it's written until it's complete
+    """
+    return "{}.{}.part".format(path, os.getpid())
+
+
+class FrameSequence(object):
+    """
+    Numbered frames on disk, ie blah.0001.exr to blah.0240.exr - with whatever gaps they have.
+    """
+    # prefix, frame number, extension. the number is the last one before the extension
+    name_regex = re.compile(r"^(.*?)(\d+)(\.\w+)$")
+
+    def __init__(self, folder, prefix, suffix):
+        self.folder = folder
+        self.prefix = prefix
+        self.suffix = suffix
+        # frame number : file name. padding can be mixed, so keep the real names
+        self.files = {}
+        self.padding = None
+
+
+    def __len__(self):
+        return len(self.files)
+
+
+    def __repr__(self):
+        return "FrameSequence({} {})".format(self.pattern, self.ranges())
+
+
+    @property
+    def frames(self):
+        return sorted(self.files)
+
+
+    @property
+    def first(self):
+        return min(self.files) if self.files else None
+
+
+    @property
+    def last(self):
+        return max(self.files) if self.files else None
+
+
+    @property
+    def pattern(self):
+        # printf style, for ffmpeg
+        return os.path.join(self.folder, "{}%0{}d{}".format(self.prefix, self.padding or 1, self.suffix))
+
+
+    def path(self, frame):
+        return os.path.join(self.folder, self.files[frame])
+
+
+    def paths(self):
+        return [self.path(f) for f in self.frames]
+
+
+    def ranges(self):
+        """
+        :return: list of (first, last) runs of consecutive frames
+        """
+        runs = []
+        for f in self.frames:
+            if runs and f == runs[-1][1] + 1:
+                runs[-1][1] = f
+            else:
+                runs.append([f, f])
+        return [tuple(r) for r in runs]
+
+
+    def gaps(self):
+        """
+        :return: list of missing frame numbers between first & last
+        """
+        missing = []
+        runs = self.ranges()
+        for (_, end), (start, _) in zip(runs, runs[1:]):
+            missing.extend(range(end + 1, start))
+        return missing
+
+
+    def clip(self, start=None, end=None):
+        """
+        :return: new FrameSequence of just the frames from start to end (inclusive). None is open ended
+        """
+        seq = FrameSequence(self.folder, self.prefix, self.suffix)
+        seq.padding = self.padding
+        seq.files = dict((f, n) for f, n in self.files.items()
+                         if (start is None or f >= start) and (end is None or f <= end))
+        return seq
+
+
+    def add(self, frame, name, digits):
+        self.files[frame] = name
+        # unpadded numbers get longer as they go - the shortest says what the padding is
+        if self.padding is None or len(digits) < self.padding:
+            self.padding = len(digits)
+
+
+    @classmethod
+    def from_pattern(cls, pattern):
+        """
+        :param pattern: printf style frame path like blah.%04d.exr
+        :return: FrameSequence of the frames matching it (maybe empty),
+        or None if it hasn't got a frame number in it
+        """
+        folder, name = os.path.split(pattern)
+        match = re.search(r"%0?\d*d", name)
+        if match is None:
+            # just a % in the file name
+            return None
+        prefix, suffix = name[:match.start()], name[match.end():]
+        return index_sequences(folder).get((prefix, suffix)) or cls(folder, prefix, suffix)
+
+
+def index_sequences(folder):
+    """
+    Sort a folder's files into frame sequences, in one pass over it.
+    :param folder: folder to look in
+    :return: dict of (prefix, suffix) : FrameSequence
+    """
+    sequences = {}
+    if not os.path.isdir(folder or "."):
+        return sequences
+    for name in list_files(folder):
+        match = FrameSequence.name_regex.match(name)
+        if not match:
+            continue
+        prefix, digits, suffix = match.groups()
+        seq = sequences.get((prefix, suffix))
+        if seq is None:
+            seq = sequences[(prefix, suffix)] = FrameSequence(folder, prefix, suffix)
+        seq.add(int(digits), name, digits)
+    return sequences
+
+
+def find_sequence(folder, prefix, frame=None):
+    """
+    :param folder: folder to look in
+    :param prefix: what the frame names start with, up to the number - ie "blah."
+    :param frame: prefer a sequence which has this frame
+    :return: the longest matching FrameSequence (of any extension), or None
+    """
+    found = [seq for (p, _), seq in index_sequences(folder).items() if p == prefix]
+    if not found:
+        return None
+    return max(found, key=lambda seq: (frame is None or frame in seq.files, len(seq)))
+
+
+def list_files(folder):
+    """
+    :param folder: folder to look in
+    :return: names of the files in it. uses scandir where there is one, which skips a stat per file
+    """
+    if scandir is None:
+        return os.listdir(folder or ".")
+    return [e.name for e in scandir(folder or ".") if e.is_file()]
+
+
+def concat_list(paths, frame_duration):
+    """
+    Write an ffconcat list of frames, for sequences that can't go in as a pattern
+    (gaps, or only some of the frames).
+    :param paths: frame files in order
+    :param frame_duration: seconds each one is shown for
+    :return: path of the list - delete it when done
+    """
+    fd, list_path = mkstemp(suffix=".ffconcat")
+    with os.fdopen(fd, "w") as f:
+        f.write("ffconcat version 1.0\n")
+        for path in paths:
+            f.write("file '{}'\n".format(path.replace("\\", "/").replace("'", "'\\''")))
+            f.write("duration {:.6f}\n".format(frame_duration))
+    return list_path
+
+
+def poster_args(path, frame=0, width=640):
+    """
+    Extra ffmpeg output for a jpeg poster, made from the same decode as the video.
+    :param path: where to write it
+    :param frame: which of the encoded frames to use - the middle one says more than the first
+    :param width: max width of the poster
+    :return: list of ffmpeg output args, to go after the video's
+    """
+    return ["-map", "0:v",
+            "-vf", "select='gte(n,{})',scale='min({},iw)':-2".format(int(frame), width),
+            "-frames:v", "1",
+            "-q:v", "5",
+            "-f", "image2", "-update", "1",
+            path]
+
+
+def find_executable(name, prism_root=None):
+    """
+    :param name: "ffmpeg" or "ffprobe"
+    :param prism_root: Prism's install folder - its bundled copy goes first
+    :return: full path of the executable, or None
+    """
+    exe = name + ".exe" if platform.system() == "Windows" else name
+    candidates = []
+    if prism_root:
+        candidates.append(os.path.join(prism_root, "Tools", "FFmpeg", "bin", exe))
+        candidates.append(os.path.join(prism_root, "Tools", exe))
+    candidates.extend(os.path.join(d, exe) for d in os.environ.get("PATH", "").split(os.pathsep) if d)
+    for path in candidates:
+        if os.path.isfile(path) and os.access(path, os.X_OK):
+            return path
+    return None
+
+
+def codec_list(ffmpeg, flag):
+    """
+    :param ffmpeg: ffmpeg executable
+    :param flag: "-encoders" or "-decoders"
+    :return: list of codec names it lists
+    """
+    try:
+        out = subprocess.check_output([ffmpeg, "-hide_banner", flag], stderr=subprocess.STDOUT)
+    except (subprocess.CalledProcessError, OSError):
+        return []
+    # lines like " V....D libvpx-vp9           libvpx VP9 (codec vp9)", after a "------" line
+    names = []
+    listing = False
+    for line in out.decode("utf-8", "replace").splitlines():
+        parts = line.split()
+        if not listing:
+            listing = line.strip().startswith("---")
+        elif len(parts) > 1:
+            names.append(parts[1])
+    return names
+
+
+def cpu_count():
+    try:
+        return max(1, min(16, multiprocessing.cpu_count()))
+    except NotImplementedError:
+        return 1
+
+
+def drain(pipe, log, chunk_size=4096):
+    """
+    Read a pipe until it closes, keeping its lines in a bounded log.
+    ffmpeg ends progress lines with \\r, so those count as line breaks too.
+    :param pipe: readable binary pipe
+    :param log: deque with a maxlen
+    :return: None
+    """
+    partial = b""
+    while True:
+        chunk = pipe.read1(chunk_size) if hasattr(pipe, "read1") else pipe.read(chunk_size)
+        if not chunk:
+            break
+        lines = re.split(b"[\r\n]", partial + chunk)
+        # a very long line without a break still shouldn't grow forever
+        partial = lines.pop()[-chunk_size:]
+        log.extend(l.decode("utf-8", "replace") for l in lines if l.strip())
+    if partial.strip():
+        log.append(partial.decode("utf-8", "replace"))
+    pipe.close()
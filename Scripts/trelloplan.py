@@ -0,0 +1,147 @@
+import time
+from multiprocessing.pool import ThreadPool
+try:
+    from queue import Queue
+except ImportError:
+    from Queue import Queue
+
+"""
+Tiny dependency graph runner for batches of Trello requests.
+Steps start as soon as everything they depend on is done, so independent ones go out concurrently.
+"""
+
+
+class Plan(object):
+    """
+    Add steps with their dependencies, then run. A failed step skips everything depending on it,
+    the rest still finishes, and then the first error is raised.
+    Per step timings are kept, for seeing where the time goes.
+    """
+    def __init__(self, name="plan", workers=4):
+        self.name = name
+        self.workers = workers
+        # step name : (func, args, kwargs, dependency names) - in order added
+        self.steps = {}
+        self.order = []
+        # step name : (start offset, duration) in seconds, once run
+        self.timings = {}
+        self.results = {}
+        self.skipped = []
+        self.elapsed = 0.0
+        self.cancelled = False
+
+
+    def __len__(self):
+        return len(self.order)
+
+
+    def add(self, name, func, args=(), kwargs=None, deps=()):
+        """
+        :param name: unique name of the step
+        :param func: callable to run
+        :param args: args for func
+        :param kwargs: kwargs for func
+        :param deps: names of steps which have to finish first. ones not in the plan are ignored
+        :return: name, for easy passing into other steps' deps
+        """
+        if name in self.steps:
+            raise ValueError("Step {} already in {}".format(name, self.name))
+        self.steps[name] = (func, args, kwargs or {}, [d for d in deps if d in self.steps])
+        self.order.append(name)
+        return name
+
+
+    def run(self, progress=None, cancel=None):
+        """
+        Run all steps, each as soon as its dependencies are done.
+        :param progress: optional function called (with no args) as each step finishes or is skipped.
+        it's called from the thread running the plan, never a worker - so it can touch the UI
+        :param cancel: optional threading.Event - once it's set, steps that haven't started are skipped.
+        ones already running still finish
+        :return: dict of step name : result
+        """
+        start = time.time()
+        done = Queue()
+        pending = list(self.order)
+        running = set()
+        failed = {}
+        finished = set()
+
+        def call(name, func, args, kwargs):
+            t = time.time()
+            try:
+                result, error = func(*args, **kwargs), None
+            except Exception as e:
+                result, error = None, e
+            done.put((name, result, error, t - start, time.time() - t))
+
+        pool = ThreadPool(self.workers) if len(self.order) > 1 else None
+        try:
+            while pending or running:
+                if pending and cancel is not None and cancel.is_set():
+                    self.cancelled = True
+                    for name in pending:
+                        self.skipped.append(name)
+                        if progress:
+                            progress()
+                    pending = []
+                for name in list(pending):
+                    func, args, kwargs, deps = self.steps[name]
+                    if any(d in failed or d in self.skipped for d in deps):
+                        pending.remove(name)
+                        self.skipped.append(name)
+                        if progress:
+                            progress()
+                    elif all(d in finished for d in deps):
+                        pending.remove(name)
+                        running.add(name)
+                        if pool:
+                            pool.apply_async(call, (name, func, args, kwargs))
+                        else:
+                            call(name, func, args, kwargs)
+                if not running:
+                    continue
+
+                name, result, error, offset, duration = done.get()
+                running.discard(name)
+                self.timings[name] = (offset, duration)
+                if error is None:
+                    finished.add(name)
+                    self.results[name] = result
+                else:
+                    failed[name] = error
+                if progress:
+                    progress()
+        finally:
+            if pool:
+                pool.close()
+
+        self.elapsed = time.time() - start
+        if failed:
+            # first one to go wrong, in plan order
+            raise next(failed[n] for n in self.order if n in failed)
+        return self.results
+
+
+    def describe(self):
+        """
+        :return: string - the steps in order, with what they're waiting on. for dry runs
+        """
+        lines = ["{}: {} steps".format(self.name, len(self.order))]
+        for name in self.order:
+            deps = self.steps[name][3]
+            lines.append("  {}{}".format(name, "  (after {})".format(", ".join(deps)) if deps else ""))
+        return "\n".join(lines)
+
+
+    def report(self):
+        """
+        :return: string - table of when each step started and how long it took
+        """
+        lines = ["{} took {:.2f}s".format(self.name, self.elapsed)]
+        for name in sorted(self.timings, key=lambda n: self.timings[n][0]):
+            offset, duration = self.timings[name]
+            lines.append("  {:<24} +{:6.2f}s {:6.2f}s".format(name, offset, duration))
+        for name in self.skipped:
+            lines.append("  {:<24} skipped".format(name))
+        return "\n".join(lines)
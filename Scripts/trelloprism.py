@@ -1,7 +1,16 @@
-import os, subprocess, json
+import os, json, time, threading
+from collections import deque
 import requests, ssl
+from requests.compat import quote
 from tempfile import gettempdir
+from multiprocessing.pool import ThreadPool
 import trelloqt
+from trellodata import TeamSnapshot
+from trelloplan import Plan
+from trellocurl import CurlTransport
+from trellostream import MultipartStream, tell
+from trelloconfig import ConfigWriter, write_json, read_json
+from trellohook import WebhookReceiver
 
 """
 Shit for connecting to Trello - syncing and posting to cards.
@@ -17,59 +26,231 @@ class NotFound(Exception):
     pass
 
 
+class Unavailable(requests.HTTPError):
+    # Trello's down or still turning us away (5xx, or 429 after the retries) - worth trying later
+    pass
+
+
+class RateLimiter(object):
+    """
+    Sliding window shared by everything sending through a handler, so bursts (big syncs, farm publishes)
+    are paced to Trello's limit instead of tripping it. Trello allows 100 requests per 10 seconds per token -
+    a request only goes once the one `limit` requests before it is `period` seconds old.
+    Keeps counters of how much it had to hold requests back.
+    """
+    def __init__(self, limit=100, period=10.0):
+        """
+        :param limit: max requests in any window
+        :param period: length of the window in seconds
+        """
+        self.limit = limit
+        self.period = period
+        # send times of the last `limit` requests, oldest first. can be in the future - they're reserved
+        self.sent = deque(maxlen=limit)
+        # nobody goes before this, after a 429
+        self.blocked_until = 0.0
+        self.lock = threading.Lock()
+        # counters
+        self.requests = 0
+        self.throttled = 0
+        self.throttled_time = 0.0
+        self.rejected = 0
+
+
+    def acquire(self, cost=1):
+        """
+        Reserve a send time for a request, sleeping until it comes.
+        :param cost: how many requests it counts as
+        :return: None
+        """
+        with self.lock:
+            now = time.time()
+            slot = max(now, self.blocked_until)
+            # how many of the window's oldest have to be out of it first
+            over = len(self.sent) + min(cost, self.limit) - self.limit
+            if over > 0:
+                slot = max(slot, self.sent[over - 1] + self.period)
+            self.sent.extend([slot] * min(cost, self.limit))
+            wait = slot - now
+            self.requests += cost
+            if wait > 0:
+                self.throttled += 1
+                self.throttled_time += wait
+        if wait > 0:
+            time.sleep(wait)
+
+
+    def backoff(self, seconds):
+        """
+        Trello said 429 - hold everyone back for a while.
+        :param seconds: how long to hold off
+        :return: None
+        """
+        with self.lock:
+            self.rejected += 1
+            self.blocked_until = max(self.blocked_until, time.time() + seconds)
+
+
+    def stats(self):
+        """
+        :return: dict of the counters
+        """
+        return {"requests": self.requests,
+                "throttled": self.throttled,
+                "throttled_time": self.throttled_time,
+                "rejected": self.rejected}
+
+
 class TrelloHandler(object):
     token_url = "https://trello.com/1/authorize?expiration=never&name={n}&scope=read,write&response_type=token&key={k}"
     template_boards = {"assets": "5c6de1f362df495355f996de",
                        "shots": "5c6de2088ac2313d84bb765b"}
+    task_paths = {"Export": "Export",
+                  "2D": os.path.join("Rendering", "2dRender"),
+                  "Playblast": "Playblasts",
+                  "Render": os.path.join("Rendering", "3dRender"),
+                  "External": os.path.join("Rendering", "external")}
+    # board actions which only touch cards - anything else on a board means a full re-fetch
+    card_actions = ("createCard", "updateCard", "deleteCard", "copyCard", "commentCard",
+                    "moveCardToBoard", "moveCardFromBoard", "convertToCardFromCheckItem",
+                    "addAttachmentToCard", "deleteAttachmentFromCard", "updateCustomFieldItem",
+                    "addMemberToCard", "removeMemberFromCard", "addLabelToCard", "removeLabelFromCard",
+                    "addChecklistToCard", "removeChecklistFromCard", "updateCheckItemStateOnCard")
+    # the only card & attachment fields anything here looks at (id always comes) - see card_params
+    card_fields = ("name", "desc", "idList", "idBoard", "closed", "url", "pos")
+    attachment_fields = ("name", "url", "date")
+    # max actions per feed request. hitting it means there's too much going on to patch
+    action_limit = 1000
+    # max urls per /batch request, and how many batch requests can be in flight at once
+    batch_limit = 10
+    batch_workers = 6
+    # how many of a publish's requests can be in flight at once
+    publish_workers = 4
+    # how many of a sync's creates can be in flight at once
+    sync_workers = 4
+    # threads for a sync's filesystem work - it's mostly waiting on the network share
+    fs_workers = 16
+    # how many times a request turned away with 429 is tried again, and base wait between
+    max_retries = 3
+    retry_delay = 5.0
+    # attachment name of the video poster used as the card cover
+    poster_name = "Poster.jpg"
+    # seconds a webhook-fed snapshot is trusted for lookups, without even listing the boards.
+    # webhooks are per board, so that's how long a brand new board can go unnoticed
+    live_max_age = 600.0
 
     def __init__(self, core):
         self.core = core
+        self.project = core.prismIni
         self.project_data = trelloqt.get_project_config(core, ("api_key", "team_url"))
         self.team_id = self.project_data["team_url"].split("/")[3]
         # self.client, self.team_id = self._connect()
+        # one session for the life of the handler - keeps its connections alive between requests
         self.session = requests.session()
-        self.is_connected = self._connect()
-        # error it
-        assert self.is_connected
-        # self.board_data = self.get_board_data()
-        self.task_paths = {"Export": "Export",
-                           "2D": os.path.join("Rendering", "2dRender"),
-                           "Playblast": "Playblasts",
-                           "Render": os.path.join("Rendering", "3dRender"),
-                           "External": os.path.join("Rendering", "external")}
+        token = self.core.getConfig(self.core.projectName, "trello_token")
+        self.session.params = {"key": self.project_data["api_key"],
+                               "token": token,}
+        self.session.headers = {"Accept": "application/json",}
+                                # "Content-Type": "application/json; charset=utf-8",}
+        # paces everything sent through this handler to the per-token limit
+        self.limiter = RateLimiter()
+        # old Pythons (ie Maya's) can't do TLS 1.2, so requests go through curl
+        self.curl = None if hasattr(ssl, "PROTOCOL_TLSv1_2") else CurlTransport()
+        # self.curl = CurlTransport()
+        # credentials are checked lazily - see connect_async & ensure_connected. a 401 resets this
+        self.is_connected = False
+        # "unchecked", "connected", "unauthorized" or "offline"
+        self.connection_state = "unchecked"
+        self.connect_thread = None
+        # last board data, by board id. loaded from disk on first use
+        self.snapshot = None
+        # raw name : validated name, see validate_string
+        self.valid_names = {}
+        self.snapshot_path = os.path.join(gettempdir(), "prismtrello_{}.json".format(self.team_id))
+        # board id : dateLastActivity as of the last sync down. lives with the project, not the machine
+        self.watermark_path = os.path.join(os.path.dirname(self.project), "trello_sync.json")
+        # when the snapshot was last brought up to date, and the webhook receiver keeping it that way
+        self.refreshed_at = 0
+        self.hook = None
+        # whether the receiver's url has webhooks on Trello, and whether the snapshot has every board
+        self.hooks_registered = False
+        self.snapshot_complete = False
+        # worker threads (publish queue, batches) share the snapshot
+        self.lock = threading.RLock()
+
+
+    def connect_async(self, callback=None):
+        """
+        Check the credentials on a worker thread, so nothing has to wait on Trello (or on being offline).
+        Anything that actually needs the connection waits on it with wait_connected / ensure_connected.
+        :param callback: optional function taking the resulting connection state. called on the worker thread
+        :return: threading.Thread doing the check
+        """
+        def check():
+            state = self.connection_state
+            try:
+                state = self.check_token()
+            finally:
+                # whatever happened, whoever's waiting on the connection has to hear about it
+                if callback:
+                    callback(state)
 
+        self.connect_thread = threading.Thread(target=check, name="PrismTrelloConnect")
+        self.connect_thread.daemon = True
+        self.connect_thread.start()
+        return self.connect_thread
 
-    def _connect(self):
+
+    def wait_connected(self, timeout=None):
         """
-        Connect to Trello and return valid client and list of boards (assets & shots)
-        :return: bool, whether the connection was successful
+        Wait for the connect_async check to finish, starting one if there's never been one.
+        :param timeout: seconds to wait, or None for as long as it takes
+        :return: string - the connection state
         """
-        try:
-            requests.get("http://www.google.com")
-        except requests.ConnectionError:
-            return False
+        if self.connect_thread is None:
+            self.connect_async()
+        self.connect_thread.join(timeout)
+        return self.connection_state
 
-        api_key = self.project_data["api_key"]
-        # team_name = validate_string(self.project_data["team_name"])
-        # team_url = "".join(self.project_data["team_name"].split()).lower()
-        token = self.core.getConfig(self.core.projectName, "trello_token")
-        self.session.params = {"key": api_key,
-                               "token": token,}
-        self.session.headers = {"Accept": "application/json",}
-                                # "Content-Type": "application/json; charset=utf-8",}
 
+    def check_token(self):
+        """
+        Cheap check of the credentials - just who the token belongs to. Never asks the user anything.
+        :return: string - the new connection state
+        """
         try:
-            # ALL fields for each board in the team
-            self.send("GET", "organizations/{}/boards".format(self.team_id))
+            self.send("GET", "members/me", params={"fields": "id"})
+            state = "connected"
         except Unauthorized:
+            state = "unauthorized"
+        except (requests.RequestException, ValueError):
+            # not reachable, or Trello's having trouble (5xx, still rate limited, garbage back)
+            state = "offline"
+
+        self.connection_state = state
+        self.is_connected = state == "connected"
+        return state
+
+
+    def ensure_connected(self):
+        """
+        Make sure the credentials are good - waits on a check that's already going, re-checks
+        if the last one came back offline, and pops up the token dialog if the token's bad.
+        Because of that dialog, has to run on the main thread.
+        :return: bool, whether the connection is good
+        """
+        if self.is_connected:
+            return True
+        if self.connect_thread and self.connect_thread.is_alive():
+            self.connect_thread.join()
+        if not self.is_connected and self.connection_state != "unauthorized":
+            self.check_token()
+        if self.connection_state == "unauthorized":
             app_name = self.core.projectName
-            self.session.params["token"] = self._get_new_token(api_key, app_name)
-            try:
-                self.send("GET", "organizations/{}/boards".format(self.team_id))
-            except Unauthorized:
-                return False
+            self.session.params["token"] = self._get_new_token(self.project_data["api_key"], app_name)
+            self.check_token()
 
-        return True
+        return self.is_connected
 
 
     def _get_new_token(self, api_key, app_name):
@@ -113,10 +294,23 @@ class TrelloHandler(object):
     def validate_string(self, s):
         """
         Remove all whitespace and CamelCase the given string.
+        Remembered, as the same board/list/card names get validated over and over.
         :param s: raw input string with whitespace and whatever for caps
         :return: Prism friendly version of the string
         """
-        return self.core.validateStr("".join(w[0].upper()+w[1:] for w in s.split()))
+        try:
+            return self.valid_names[s]
+        except KeyError:
+            valid = self.valid_names[s] = self.core.validateStr("".join(w[0].upper()+w[1:] for w in s.split()))
+            return valid
+
+
+    def name_key(self, s):
+        """
+        :param s: Trello name
+        :return: validated, lowercase version to compare against Prism names
+        """
+        return self.validate_string(s).lower()
 
 
     def send(self, method, uri, **kwargs):
@@ -129,21 +323,126 @@ class TrelloHandler(object):
         :param kwargs: any params for the request
         :return: json of the specified trello object
         """
+        files = kwargs.get("files")
+        body = files["file"][1] if files else None
+        stream = None
+        if hasattr(body, "read") and not self.curl:
+            # upload straight from the file-like, a chunk at a time, instead of
+            # requests building the whole multipart body in memory
+            kwargs = dict(kwargs)
+            stream = MultipartStream("file", kwargs.pop("files")["file"][0], body)
+            kwargs["data"] = stream
+            kwargs["headers"] = {"Content-Type": stream.content_type}
+        # a streamed body can only be sent again if it can be rewound
+        start = tell(body) if hasattr(body, "read") else None
+        can_resend = not hasattr(body, "read") or start is not None
+
+        req = self._prepare(method, uri, **kwargs)
+
+        for attempt in range(self.max_retries + 1):
+            self.limiter.acquire(self._request_cost(uri))
+            retry_after = None
+            if self.curl:
+                # send as a cURL subprocess.
+                code, content = self.curl_send(method, req.url, files)
+            else:
+                r = self.session.send(req)
+                code, content = r.status_code, r.content
+                retry_after = r.headers.get("Retry-After")
+
+            if code != 429 or attempt == self.max_retries or not can_resend:
+                break
+            self.limiter.backoff(self._retry_delay(retry_after, attempt))
+            if stream is not None:
+                stream.rewind()
+            elif start is not None:
+                body.seek(start)
+
+        return self._read_response(code, content)
+
+
+    def send_many(self, calls):
+        """
+        Send several requests at once. Over the session they go out concurrently;
+        through curl they all go through one process (and one connection).
+        :param calls: list of (method, uri, kwargs) - see send
+        :return: list of json results, in the same order as calls
+        """
+        if not calls:
+            return []
+        if self.curl:
+            reqs = [(method, self._prepare(method, uri, **kwargs).url, kwargs.get("files"))
+                    for method, uri, kwargs in calls]
+            self.limiter.acquire(sum(self._request_cost(uri) for _, uri, _ in calls))
+            responses = self.curl.send_many(reqs)
+            if any(code == 429 for code, _ in responses):
+                self.limiter.backoff(self._retry_delay(None, 0))
+            # anything turned away gets another go, one at a time
+            return [self.send(call[0], call[1], **call[2]) if code == 429 else self._read_response(code, content)
+                    for call, (code, content) in zip(calls, responses)]
+
+        if len(calls) == 1:
+            return [self.send(calls[0][0], calls[0][1], **calls[0][2])]
+        pool = ThreadPool(min(len(calls), self.batch_workers))
+        try:
+            # map keeps order, so results line up with calls
+            return pool.map(lambda call: self.send(call[0], call[1], **call[2]), calls)
+        finally:
+            pool.close()
+
+
+    def _prepare(self, method, uri, **kwargs):
+        """
+        :param method: "GET", "PUT", "POST", "DELETE"
+        :param uri: the trello endpoint
+        :param kwargs: any params for the request
+        :return: requests.PreparedRequest, with the session's auth params
+        """
         url = "https://api.trello.com/1/{}".format(uri.lstrip("/"))
-        req = self.session.prepare_request( requests.Request(method, url, **kwargs) )
+        return self.session.prepare_request( requests.Request(method, url, **kwargs) )
+
+
+    def _request_cost(self, uri):
+        """
+        :param uri: the trello endpoint
+        :return: how many requests it counts as against the rate limit - batches count each url
+        """
+        if uri.lstrip("/").startswith("batch?urls="):
+            return uri.count(",") + 1
+        return 1
 
-        if not hasattr(ssl, "PROTOCOL_TLSv1_2"):
-        # if True:
-            # send as a cURL subprocess.
-            code, content = self.curl_send(method, req.url, kwargs.get("files"))
-        else:
-            r = self.session.send(req)
-            code, content = r.status_code, r.content
 
-        if code == 401:
+    def _retry_delay(self, retry_after, attempt):
+        """
+        :param retry_after: Retry-After header of a 429, if there was one
+        :param attempt: how many tries have already been turned away
+        :return: seconds to wait before trying again
+        """
+        try:
+            return float(retry_after)
+        except (TypeError, ValueError):
+            # no (or a date) header - wait out most of the 10 second window, then double
+            return self.retry_delay * 2 ** attempt
+
+
+    def _read_response(self, code, content):
+        """
+        Turn a response into json, or the right exception.
+        :param code: HTTP status code - 0 if there was no response at all
+        :param content: response body
+        :return: json of the response
+        """
+        if code == 0:
+            raise requests.ConnectionError("No response from Trello")
+        elif code == 401:
+            # token's gone bad - check it again next time someone can be asked for a new one
+            self.is_connected = False
+            self.connection_state = "unauthorized"
             raise Unauthorized(content)
         elif code == 404:
             raise NotFound(content)
+        elif code == 429 or code >= 500:
+            raise Unavailable(content)
         elif code != 200:
             # result.raise_for_status()
             raise requests.HTTPError(content)
@@ -157,112 +456,303 @@ class TrelloHandler(object):
         Send the HTTPS trello request via cURL in a subprocess.
         :param method: HTTP method of the request
         :param url: the pre-encoded URL (thanks requests)
-        :param files: a dict of {"file": (name, contents)} or None
-        :return: trello json data
-        """
-        if files:
-            # requests takes files as name, binary string
-            # but curl needs a filename - so make one
-            name, bytestr = files["file"]
-            fn = os.path.join(gettempdir(), name)
-            with open(fn, "wb") as of:
-                of.write(bytestr)
-            curl_args = ["--form", "file=@{}".format(fn), "--url", url]
-        else:
-            fn = os.path.join(gettempdir(), "prism")
-            curl_args = ["--url", url]
-
-        # subprocess needs command as a list that is basically split along whitespace
-        curl_args = ["curl", "-s", "-o", fn, "-w", "%{http_code}",
-                     "--request", method] + curl_args
-
-        startupinfo = None
-        if os.name == "nt":
-            startupinfo = subprocess.STARTUPINFO()
-            # set startup invisible flag
-            startupinfo.dwFlags |= subprocess.STARTF_USESHOWWINDOW
-        # open subprocess pipe and get its return value, which oughta be a json-loadable string
-        response = subprocess.check_output(curl_args, startupinfo=startupinfo)
-        with open(fn) as of:
-            content = of.read()
-
+        :param files: a dict of {"file": (name, contents or readable file-like)} or None
+        :return: status code & response content
+        """
         # calling method takes care of HTTP error handling
-        return int(response), content
+        return self.curl.send(method, url, files)
 
 
     def batch_get(self, queries):
         """
         Reject empty query list (edge case of a team with 0 boards)
-        :param queries: list of trello endpoints to be joined together into a batch request
+        Trello caps batch requests at batch_limit urls, so queries are split into chunks
+        which are sent all at once (see send_many).
+        :param queries: list of trello endpoints to be joined together into a batch request.
+        they can have query strings, but no commas - that's what separates them
         :return: big ol' list of dicts, len(result) = len(queries) & queries[i] -> result[i]
         then its response code is a key for accessing the json data from the endpoint
         """
         if not queries:
             return []
+        if any("," in q for q in queries):
+            raise ValueError("Batch urls can't have commas in them: {}".format(queries))
         batch_url = "/batch?urls={}"
-        return self.send("GET", batch_url.format(",".join(queries)))
+        chunks = [queries[i:i+self.batch_limit] for i in range(0, len(queries), self.batch_limit)]
+        # each url is encoded, or its own ? and &s would be taken as part of the batch request's query
+        results = self.send_many([("GET", batch_url.format(",".join(quote(q, safe="/") for q in chunk)), {})
+                                  for chunk in chunks])
+        results = [r for chunk in results for r in chunk]
+        if len(results) != len(queries):
+            raise ValueError("Batch gave {} results for {} urls".format(len(results), len(queries)))
+        return results
 
 
-    def get_board_data(self):
+    def get_board_data(self, full=False, skip=None, live=False):
         """
-        Batch get for ALL data on the Trello team at once. Batching majorly reduces HTTP traffic.
-        :return: large dict of Trello json info, massaged slightly so it's nested to have
+        Get ALL data on the Trello team. The last snapshot is kept (in memory and on disk),
+        so by default only boards whose dateLastActivity moved since then are looked at again -
+        and of those, only the changed cards are re-fetched if the board's actions feed says
+        nothing but cards were touched. Batching majorly reduces HTTP traffic.
+        :param full: bool - throw the snapshot away and re-download everything
+        :param skip: optional dict of board id : dateLastActivity. boards still at that activity
+        aren't fetched or refreshed at all - they're left as they were in the snapshot, or left out
+        :param live: bool - if webhooks are keeping the snapshot current (see is_live), just use it
+        :return: TeamSnapshot - indexed by id, and snapshot[pipe] gives nested board json with
         board["lists"], list["cards"], card["customFieldItems"]
         """
-        boards = self.send("GET", "organizations/{}/boards".format(self.team_id))
+        with self.lock:
+            if live and not full and self.is_live():
+                return self.snapshot
+            return self._refresh_snapshot(full, skip or {})
+
+
+    def _refresh_snapshot(self, full, skip):
+        """
+        Bring the snapshot up to date - see get_board_data.
+        :param full: bool - throw the snapshot away and re-download everything
+        :param skip: dict of board id : dateLastActivity of boards to leave alone
+        :return: TeamSnapshot
+        """
+        if full or self.snapshot is None:
+            self.snapshot = TeamSnapshot(self.name_key) if full else self._load_snapshot()
+
+        all_boards = self.send("GET", "organizations/{}/boards".format(self.team_id))
+        # boards that were closed or deleted since last time
+        for board_id in set(self.snapshot.boards) - set(b["id"] for b in all_boards):
+            self.snapshot.remove_board(board_id)
+
+        boards = []
+        for b in all_boards:
+            if skip.get(b["id"]) != b["dateLastActivity"]:
+                boards.append(b)
+            elif b["id"] in self.snapshot and \
+                    self.snapshot.boards[b["id"]]["dateLastActivity"] != b["dateLastActivity"]:
+                # skipped, but the snapshot's copy is behind - drop it rather than keep stale data
+                self.snapshot.remove_board(b["id"])
+        changed = [b for b in boards if b["id"] in self.snapshot and
+                   self.snapshot.boards[b["id"]]["dateLastActivity"] != b["dateLastActivity"]]
+        stale = [b for b in boards if b["id"] not in self.snapshot]
+        stale.extend(self._patch_changed_cards(changed))
+        self._fetch_boards(stale)
+
+        # top level board info (name, prefs, watermark) is always fresh
+        for b in boards:
+            self.snapshot.update_board(b)
+        self.snapshot.order([b["id"] for b in all_boards])
+
+        self._save_snapshot()
+        self.refreshed_at = time.time()
+        # boards skipped for their watermark may have been left out
+        self.snapshot_complete = all(b["id"] in self.snapshot for b in all_boards)
+        return self.snapshot
+
+
+    def _fetch_boards(self, boards):
+        """
+        Full download of the given boards into the snapshot.
+        Lists & custom fields go in batches. Cards are one query per board, custom fields & attachments
+        included and projected down to what's used - that can't be batched, the batch urls are comma separated.
+        :param boards: list of board json (top level info only)
+        :return: None
+        """
+        if not boards:
+            return
         batch_paths = ["/board/{}/lists/open",
-                      "/boards/{}/customFields",
-                      "/board/{}/cards/open?customFieldItems=true",
-                      "/boards/{}/cards/open?attachments=true",]
+                      "/boards/{}/customFields",]
                       # "/boards/{}/checklists",]
 
         # form is clustered by board, ie:
-        # board1.lists, board1.cards, board2.lists, board2.cards, etc
+        # board1.lists, board1.fields, board2.lists, board2.fields, etc
         board_urls = [uri.format(b["id"]) for b in boards for uri in batch_paths]
         all_data = self.batch_get(board_urls)
-        data = {"assets": [], "shots": [], "other": []}
-        # step by four (or number of batch paths)
+        all_cards = self.send_many([("GET", "boards/{}/cards/open".format(b["id"]), {"params": self.card_params()})
+                                    for b in boards])
+        # step by two (or number of batch paths)
         step = len(batch_paths)
-        for i, board_data in enumerate(boards):
+        for i, (board_data, cards) in enumerate(zip(boards, all_cards)):
             i *= step
-            board_data["lists"] = all_data[i].get("200")
-            for l in board_data["lists"]:
-                l["cards"] = []
-            board_data["customFields"] = all_data[i+1].get("200")
-
-            # outermost loop is cards
-            for n, c in enumerate(all_data[i+2].get("200")):
-                # c["checklists"] = []
-                # for cl in all_data[i+3].get("200"):
-                #     if cl["idCard"] == c["id"]:
-                #         c["checklists"].append(cl)
-                # card order is the same. merge. i+2 is custom fields, i+3 is attachments
-                c.update(all_data[i+3].get("200")[n])
-
-                for cf in c["customFieldItems"]:
-                    for cf_def in board_data["customFields"]:
-                        # find the right definition
-                        if cf["idCustomField"] == cf_def["id"]:
-                            # assign name and list value if necessary
-                            cf["name"] = cf_def["name"]
-                            if cf_def["type"] == "list":
-                                # get value from cf_def
-                                cf["value_dict"] = dict((o["id"], o["value"]) for o in cf_def["options"])
-
-                for l in board_data["lists"]:
-                    if c["idList"] == l["id"]:
-                        l["cards"].append(c)
-
-            # separate into sectors
-            bg = board_data["prefs"]["background"]
-            if bg == "purple":
-                data["assets"].append(board_data)
-            elif bg == "orange":
-                data["shots"].append(board_data)
-            else:
-                data["other"].append(board_data)
+            # cards are filed by their own idList & id, so their order doesn't matter
+            self.snapshot.set_board(board_data, all_data[i].get("200"), all_data[i+1].get("200"), cards)
+
+
+    def card_params(self):
+        """
+        :return: query params for getting cards with their custom field items & attachments,
+        and only the fields that get used
+        """
+        return {"customFieldItems": "true",
+                "attachments": "true",
+                "fields": ",".join(self.card_fields),
+                "attachment_fields": ",".join(self.attachment_fields)}
+
+
+    def _patch_changed_cards(self, boards):
+        """
+        Read the actions feed of boards which have had activity since their snapshot watermark.
+        If all that happened was card stuff, re-fetch only those cards and patch them in.
+        :param boards: list of board json (top level info only) whose dateLastActivity moved
+        :return: list of boards which had more going on, and so need a full re-fetch
+        """
+        action_urls = ["/boards/{}/actions?limit={}&since={}".format(
+            b["id"], self.action_limit, self.snapshot.boards[b["id"]]["dateLastActivity"]) for b in boards]
+        stale = {}
+        card_ids = set()
+        for b, result in zip(boards, self.batch_get(action_urls)):
+            actions = result.get("200")
+            if actions is None or len(actions) >= self.action_limit or \
+                    any(a["type"] not in self.card_actions or "card" not in a["data"] for a in actions):
+                stale[b["id"]] = b
+                continue
+            card_ids.update(a["data"]["card"]["id"] for a in actions)
+
+        card_ids = list(card_ids)
+        card_urls = ["/cards/{}?customFieldItems=true&attachments=true".format(c) for c in card_ids]
+        for card_id, result in zip(card_ids, self.batch_get(card_urls)):
+            card = result.get("200")
+            # deleted, archived or moved off the team - removal is enough
+            self.snapshot.remove_card(card_id)
+            if card and not card["closed"] and card["idBoard"] in self.snapshot:
+                if not self.snapshot.add_card(card):
+                    # landed in a list the snapshot doesn't know about
+                    stale.setdefault(card["idBoard"], next(
+                        (b for b in boards if b["id"] == card["idBoard"]), None))
+
+        # full re-fetch trumps any patching that happened
+        return [b for b in stale.values() if b]
+
+
+    def _load_snapshot(self):
+        """
+        Read the last board data snapshot from disk.
+        :return: TeamSnapshot - empty if there's no good snapshot
+        """
+        boards = read_json(self.snapshot_path)
+        try:
+            return TeamSnapshot.from_json(boards, self.name_key)
+        except (TypeError, ValueError, KeyError):
+            # nothing there, or it's from an older version
+            return TeamSnapshot(self.name_key)
+
+
+    def _save_snapshot(self):
+        """
+        Write the board data snapshot to disk so it outlives this handler.
+        It's only a cache (shared by every Prism on the machine), so failing to save it is no reason
+        to stop a sync or publish - the next refresh just has more to fetch.
+        :return: None
+        """
+        try:
+            write_json(self.snapshot_path, self.snapshot.to_json())
+        except (IOError, OSError) as e:
+            print("Couldn't save the Trello snapshot: {}".format(e))
+
+
+    def load_watermarks(self):
+        """
+        :return: dict of board id : dateLastActivity as of the last sync down. empty if never synced
+        """
+        return read_json(self.watermark_path) or {}
+
+
+    def save_watermarks(self, watermarks):
+        """
+        :param watermarks: dict of board id : dateLastActivity
+        :return: None
+        """
+        write_json(self.watermark_path, watermarks, indent=1, sort_keys=True)
+
+
+    def is_live(self):
+        """
+        :return: bool - whether the webhook receiver is up with webhooks pointing at it,
+        and the snapshot has every board and was refreshed recently enough to trust that it's caught
+        everything since
+        """
+        return self.hook is not None and self.hook.running and self.hooks_registered and \
+            self.snapshot is not None and self.snapshot_complete and \
+            time.time() - self.refreshed_at < self.live_max_age
 
-        return data
+
+    def start_webhooks(self, port, callback_url=None, secret=None):
+        """
+        Start a local webhook receiver which keeps the snapshot current as things change on Trello.
+        If it's reachable from outside, give its url and every board gets a webhook pointing at it.
+        :param port: port to listen on
+        :param callback_url: public url Trello can reach the receiver at (ie through a tunnel).
+        without one nothing's registered, and only forwarded or replayed webhooks come in
+        :param secret: Trello app secret, to check that payloads really come from Trello.
+        required with a callback_url
+        :return: trellohook.WebhookReceiver
+        """
+        self.stop_webhooks()
+        self.hook = WebhookReceiver(self.apply_webhook, port, secret=secret, callback_url=callback_url)
+        self.hook.start()
+        # now it's listening, catch up on anything that happened before
+        self.get_board_data()
+        if callback_url:
+            self.register_webhooks(callback_url)
+        return self.hook
+
+
+    def stop_webhooks(self):
+        """
+        :return: None
+        """
+        if self.hook:
+            self.hook.stop()
+            self.hook = None
+        self.hooks_registered = False
+
+
+    def register_webhooks(self, callback_url):
+        """
+        Point a webhook at the receiver for each board on the team which doesn't have one.
+        :param callback_url: public url of the receiver
+        :return: list of new webhook json
+        """
+        token = self.session.params["token"]
+        hooked = set(w["idModel"] for w in self.send("GET", "tokens/{}/webhooks".format(token))
+                     if w["callbackURL"] == callback_url and w.get("active", True))
+        with self.lock:
+            board_ids = [b for b in self.snapshot.boards if b not in hooked]
+        hooks = self.send_many([("POST", "webhooks", {"params": {
+            "callbackURL": callback_url, "idModel": b, "description": "PrismTrello"}}) for b in board_ids])
+        self.hooks_registered = True
+        return hooks
+
+
+    def apply_webhook(self, action):
+        """
+        Keep the snapshot current with an action from the webhook receiver.
+        What the payload doesn't carry (ie a new card's custom fields) is fetched, just for that card -
+        a board that can't be followed is dropped, to be fetched whole by the next refresh.
+        :param action: action json
+        :return: None
+        """
+        with self.lock:
+            if self.snapshot is None:
+                self.snapshot = self._load_snapshot()
+            if self.snapshot.apply_action(action):
+                return
+
+            data = action["data"]
+            board_id = data.get("board", {}).get("id")
+            if action["type"] in self.card_actions and "card" in data:
+                card_id = data["card"]["id"]
+                try:
+                    card = self.send("GET", "cards/{}".format(card_id), params=self.card_params())
+                except NotFound:
+                    card = None
+                self.snapshot.remove_card(card_id)
+                if not card or card["closed"] or card["idBoard"] not in self.snapshot or \
+                        self.snapshot.add_card(card):
+                    self.snapshot.mark_activity(board_id, action.get("date"))
+                    return
+
+            if board_id in self.snapshot:
+                self.snapshot.remove_board(board_id)
+                self.snapshot_complete = False
 
 
     def get_task_dict(self, board):
@@ -278,113 +768,256 @@ class TrelloHandler(object):
             return {}
 
 
-    def sync_from_prism(self, set_max_func, increment_func):
+    def sync_from_prism(self, set_max_func, increment_func, dry_run=False, cancel=None):
         """
         Sync Trello boards to match Prism directory structure.
         Asset categories are joined using "/" for Trello board names.
+        Works out everything missing first (see plan_prism_sync), then makes it -
+        new boards at once, then all their lists at once.
         :param set_max: function from parent to set maximum value
         :param increment: function from parent to signal progress
-        :return:
+        :param dry_run: only print what would be done
+        :param cancel: optional threading.Event - set it to stop before the next board or list.
+        whatever was made by then still gets linked up
+        :return: the trelloplan.Plan
+        """
+        with self.lock:
+            self.get_board_data()
+            plan, entities = self.plan_prism_sync()
+
+        if dry_run:
+            print(plan.describe())
+            print("{} entityinfo.ini files to link".format(len(entities)))
+            return plan
+
+        # +1 for the ini files at the end
+        set_max_func(len(plan) + 1)
+        try:
+            plan.run(progress=increment_func, cancel=cancel)
+        finally:
+            print(plan.report())
+            # ids go in the ini files all at once - one write per file, and only if they changed.
+            # anything whose board or list didn't get made keeps what it had
+            configs = ConfigWriter(self.core)
+            for config, board_ref, list_ref in entities:
+                b, l = self._resolve(plan, board_ref), self._resolve(plan, list_ref)
+                if b and l:
+                    configs.update(config, "trello", {"board_id": b["id"], "list_id": l["id"]})
+            configs.flush()
+            increment_func()
+        return plan
+
+
+    def plan_prism_sync(self):
+        """
+        Diff the Prism project against the snapshot. Nothing is sent.
+        :return: trelloplan.Plan of the boards & lists to make, and a list of
+        (entityinfo.ini path, board, list) - board & list are json if they exist already,
+        otherwise the name of the plan step making them
+        """
+        plan = Plan("Sync Prism -> Trello", self.sync_workers)
+        entities = []
+        new_boards = {}
+        new_lists = {}
+        # board : next free list position, to keep new lists in order though they're made all at once
+        positions = {}
+
+        for pipe, category, entity, config in self._prism_entities():
+            board_key = (pipe, category.lower())
+            board_ref = self.snapshot.find_board(*board_key)
+            if board_ref is None:
+                board_ref = new_boards.get(board_key)
+                if board_ref is None:
+                    board_ref = new_boards[board_key] = plan.add(
+                        "board {}/{}".format(pipe, category), self._create_board, (pipe, category))
+
+            list_ref = None
+            if isinstance(board_ref, dict):
+                list_ref = self.snapshot.find_list(board_ref["id"], entity.lower())
+            if list_ref is None:
+                list_key = board_key + (entity.lower(),)
+                list_ref = new_lists.get(list_key)
+                if list_ref is None:
+                    if board_key not in positions:
+                        lists = board_ref["lists"] if isinstance(board_ref, dict) else []
+                        positions[board_key] = max([l.get("pos", 0) for l in lists] or [0])
+                    positions[board_key] += 1024
+                    # a new board's lists wait for it
+                    deps = [] if isinstance(board_ref, dict) else [board_ref]
+                    list_ref = new_lists[list_key] = plan.add(
+                        "list {}/{}/{}".format(pipe, category, entity), self._apply_list,
+                        (plan, board_ref, entity, positions[board_key]), deps=deps)
+
+            entities.append((config, board_ref, list_ref))
+
+        return plan, entities
+
+
+    def _prism_entities(self):
+        """
+        Walk the Prism project for its assets & shots.
+        :return: list of (pipe, category, entity, entityinfo.ini path)
         """
-        data = self.get_board_data()
         ap = self.core.getAssetPath()
         sp = self.core.getShotPath()
+        entities = []
 
         # asset_paths = self.core.getAssetPaths()
-        asset_paths = self.core.getEntityPath()
-        shot_paths = [sd for sd in os.listdir(sp) if os.path.isdir(os.path.join(sp, sd))]
-        set_max_func(len(asset_paths) + len(shot_paths))
-
-        # start with assets - get all of them and
-        for asset_dir in asset_paths:
-            config = os.path.join(asset_dir, "entityinfo.ini")
-
+        for asset_dir in self.core.getEntityPath():
             category = os.path.relpath(os.path.dirname(asset_dir), ap).replace(os.path.sep, "/")
             entity = os.path.basename(asset_dir)
+            entities.append(("assets", category, entity, os.path.join(asset_dir, "entityinfo.ini")))
 
-            # get_* functions CREATE the board/list if it doesn't exist
-            b = self.get_category_board(data["assets"], "assets", category)
-            l = self.get_entity_list(b, entity)
-            self.core.setConfig("trello", "board_id", b["id"], configPath=config)
-            self.core.setConfig("trello", "list_id", l["id"], configPath=config)
-
-            increment_func()
-
-        for sd in os.listdir(sp):
+        for sd in sorted(os.listdir(sp)):
             shot_dir = os.path.join(sp, sd)
-            config = os.path.join(shot_dir, "entityinfo.ini")
+            if not os.path.isdir(shot_dir):
+                continue
             category, entity = sd.split("-", 1)
+            entities.append(("shots", category, entity, os.path.join(shot_dir, "entityinfo.ini")))
 
-            b = self.get_category_board(data["shots"], "shots", category)
-            l = self.get_entity_list(b, entity)
-            self.core.setConfig("trello", "board_id", b["id"], configPath=config)
-            self.core.setConfig("trello", "list_id", l["id"], configPath=config)
+        return entities
+
+
+    def _resolve(self, plan, ref):
+        """
+        :param plan: the Plan ref came from
+        :param ref: json, or the name of a step which makes it
+        :return: json, or None if the step didn't work out
+        """
+        if isinstance(ref, dict):
+            return ref
+        return plan.results.get(ref)
 
-            increment_func()
 
+    def _apply_list(self, plan, board_ref, entity, pos):
+        # plan step - the board might only just have been made by an earlier step
+        return self._create_list(self._resolve(plan, board_ref), entity, pos)
 
-    def sync_from_trello(self, set_max_func, increment_func):
+
+    def sync_from_trello(self, set_max_func, increment_func, full=False, cancel=None):
         """
         Sync Prism dirs to match Trello boards.
         Nested categories are not supported.
+        Boards which haven't had any activity since the last sync (see load_watermarks)
+        aren't fetched or walked at all.
+        What's already on disk is scanned up front, then the missing folders are made
+        on a pool of threads - every filesystem call is a round trip on a network share.
         :param set_max: function from parent to set maximum value
         :param increment: function from parent to signal progress
+        :param full: bool - ignore the watermarks and go through every board,
+        ie to put back folders removed by hand
+        :param cancel: optional threading.Event - set it to stop before the next entity.
+        entities already done keep their ini files, but no board counts as synced
         :return: None
         """
-        data = self.get_board_data()
-        ap = self.core.getAssetPath()
-        sp = self.core.getShotPath()
-
-        # total number of entities
-        set_max_func(sum(len(b["lists"]) for b in data["shots"]) +
-                     sum(len(b["lists"]) for b in data["assets"]))
+        watermarks = {} if full else self.load_watermarks()
+        # the webhook receiver changes the snapshot as things come in - hold it still while it's walked
+        with self.lock:
+            data = self.get_board_data(full=full, skip=watermarks)
+            ap = self.core.getAssetPath()
+            sp = self.core.getShotPath()
+            # anything left in the snapshot at its watermark was skipped by the refresh
+            synced = dict((b["id"], b["dateLastActivity"]) for b in data.boards.values()
+                          if watermarks.get(b["id"]) != b["dateLastActivity"])
+
+            # basepath, board, list, [(task path, card)] for each entity
+            entities = []
+            skipped = 0
+            for pipe, path in (("assets", ap), ("shots", sp)):
+                for board in data[pipe]:
+                    if board["id"] not in synced:
+                        continue
+                    if "template" in board["name"].lower():
+                        skipped += len(board["lists"])
+                        continue
+
+                    # pprint(board)
+                    # bn = self.validate_string(board["name"])
+                    if pipe == "assets":
+                        # this is the only way to support nested categories - split now
+                        # and rejoin, including formattable spot at the end for entity
+                        cats = [self.validate_string(c) for c in board["name"].split("/")] + ["{}"]
+                        cat_path = os.path.join(path, *cats)
+                    elif pipe == "shots":
+                        cat = self.validate_string(board["name"])
+                        cat_path = os.path.join(path, "{}-{}".format(cat, "{}"))
+                    else:
+                        # get the linter to shut up
+                        return
+
+                    task_type_dict = self.get_task_dict(board)
+                    for l in board["lists"]:
+                        ln = self.validate_string(l["name"])
+                        basepath = cat_path.format(ln)
+                        tasks = []
+                        for c in l["cards"]:
+                            task_path = self.card_task_dir(basepath, c, task_type_dict)
+                            if task_path:
+                                tasks.append((task_path, c))
+                        entities.append((basepath, board, l, tasks))
+
+        # total number of entities, +1 for the ini files at the end
+        set_max_func(len(entities) + skipped + 1)
+        for _ in range(skipped):
+            increment_func()
 
-        for pipe, path in (("assets", ap), ("shots", sp)):
-            for board in data[pipe]:
-                if "template" in board["name"].lower():
-                    for _ in board["lists"]: increment_func()
+        pool = ThreadPool(self.fs_workers)
+        try:
+            # one listing per parent folder, rather than an exists() per folder
+            existing = list_dirs(pool, set(os.path.dirname(e[0]) for e in entities))
+            new_entities = set(e[0] for e in entities if not has_dir(existing, e[0]))
+            # then the task type folders of the entities that are there. new ones have no tasks yet
+            task_parents = set()
+            for basepath, _, _, tasks in entities:
+                if basepath not in new_entities:
+                    task_parents.update(os.path.dirname(t[0]) for t in tasks)
+            existing.update(list_dirs(pool, task_parents))
+
+            # (path, section, values) for each entity's ini files - only written once its folders are
+            entity_configs = []
+            jobs = []
+            for basepath, board, l, tasks in entities:
+                writes = [(os.path.join(basepath, "entityinfo.ini"), "trello",
+                           {"board_id": board["id"], "list_id": l["id"]})]
+                new_tasks = [t for t in tasks if basepath in new_entities or not has_dir(existing, t[0])]
+                for task_path, c in new_tasks:
+                    writes.append((os.path.join(task_path, "taskinfo.ini"), "trello", {"id": c["id"]}))
+                entity_configs.append(writes)
+                jobs.append((basepath, basepath in new_entities, [t[0] for t in new_tasks]))
+
+            def make_dirs(item):
+                i, job = item
+                if cancel is not None and cancel.is_set():
+                    return None
+                make_entity_dirs(job)
+                return i
+
+            configs = ConfigWriter(self.core, self.fs_workers)
+            # workers only touch the disk - progress is counted here, where it's safe to touch the UI
+            for i in pool.imap_unordered(make_dirs, enumerate(jobs)):
+                if i is None:
                     continue
-
-                # pprint(board)
-                # bn = self.validate_string(board["name"])
-                if pipe == "assets":
-                    # this is the only way to support nested categories - split now
-                    # and rejoin, including formattable spot at the end for entity
-                    cats = [self.validate_string(c) for c in board["name"].split("/")] + ["{}"]
-                    cat_path = os.path.join(path, *cats)
-                elif pipe == "shots":
-                    cat = self.validate_string(board["name"])
-                    cat_path = os.path.join(path, "{}-{}".format(cat, "{}"))
-                else:
-                    # get the linter to shut up
-                    return
-
-                task_type_dict = self.get_task_dict(board)
-                for l in board["lists"]:
-                    ln = self.validate_string(l["name"])
-                    basepath = cat_path.format(ln)
-
-                    if not os.path.exists(basepath):
-                        for x in ("Export", "Playblasts", "Rendering", "Scenefiles"):
-                            os.makedirs(os.path.join(basepath, x))
-
-                    config = os.path.join(basepath, "entityinfo.ini")
-                    self.core.setConfig("trello", "board_id", board["id"], configPath=config)
-                    self.core.setConfig("trello", "list_id", l["id"], configPath=config)
-
-                    for c in l["cards"]:
-                        self.get_dir_for_card(basepath, c, task_type_dict)
-
-                    increment_func()
+                for path, section, values in entity_configs[i]:
+                    configs.update(path, section, values)
+                increment_func()
+        finally:
+            pool.close()
+
+        configs.flush()
+        if cancel is not None and cancel.is_set():
+            return
+        # only once everything's on disk - an interrupted sync goes through those boards again
+        watermarks.update(synced)
+        self.save_watermarks(watermarks)
+        increment_func()
 
 
-    def get_dir_for_card(self, basepath, card_json, task_types):
+    def card_task_dir(self, basepath, card_json, task_types):
         """
-        Get the task directory of given card.
         :param basepath: asset/shot path
         :param card_json: data from trello api
         :param task_types: dict of parent board, to get custom field value
-        :return: task path
+        :return: the task directory of given card, or None if it hasn't got a type
         """
         try:
             task_type = next(
@@ -395,13 +1028,7 @@ class TrelloHandler(object):
 
         task_path = self.task_paths[task_types[task_type["idValue"]]]
         task_name = self.validate_string(card_json["name"])
-        task_path = os.path.join(basepath, task_path, task_name)
-        if not os.path.exists(task_path):
-            os.makedirs(task_path)
-            config = os.path.join(task_path, "taskinfo.ini")
-            self.core.setConfig("trello", "id", card_json["id"], configPath=config)
-
-        return task_type
+        return os.path.join(basepath, task_path, task_name)
 
 
     def publish_to_card(self, data):
@@ -412,12 +1039,25 @@ class TrelloHandler(object):
         :param data: dict - the formatted publish data
         :return: None
         """
-        board_data = self.get_board_data()[data["pipe"]]
-        card, card_id = self.get_card(board_data, data)
+        t = time.time()
+        card, card_id, fields = self.get_card(data)
+        print("Found card for {} in {:.2f}s".format(data["task"], time.time() - t))
 
         # BEGIN CARD EDITS
+        # most of these don't depend on each other, so they go out together
+        plan = Plan("Publish {}".format(data["task"]), self.publish_workers)
+        # steps which can't just be done again went through on an earlier try (ie before a queue retry)
+        # are kept in the publish data - redoing a rotation would push the real previous version off
+        done = data.setdefault("done_steps", [])
+
+        def record(name, func):
+            def step(*args, **kwargs):
+                result = func(*args, **kwargs)
+                done.append(name)
+                return result
+            return step
         # bump the list
-        self.send("PUT", "lists/{}".format(card["idList"]), params={"pos": "top"})
+        plan.add("bump list", self.send, ("PUT", "lists/{}".format(card["idList"])), {"params": {"pos": "top"}})
 
         # change description
         # prism publish info designated by ### tag
@@ -435,7 +1075,7 @@ class TrelloHandler(object):
                     "pos": "top",
                     "subscribed": "true"}
         # PUT updated descriptions
-        self.send("PUT", "cards/{}".format(card_id), params=put_args)
+        plan.add("update card", self.send, ("PUT", "cards/{}".format(card_id)), {"params": put_args})
 
         # leave a comment or attachment - that's another POST request each
         # first: determine if there is an image/video to attach
@@ -443,55 +1083,202 @@ class TrelloHandler(object):
             # format for attachment type
             latest = "LatestVersion.{}".format(data["attach_type"])
             prev = "PreviousVersion.{}".format(data["attach_type"])
-            # DELETE previous version if it exists, and rename old latest to previous.
-            for a in card["attachments"]:
-                if a["name"] == prev:
-                    self.send("DELETE", "cards/{}/attachments/{}".format(card_id, a["id"]))
-                elif a["name"] == latest:
-                    self.send("PUT", "cards/{}/attachments/{}".format(card_id, a["id"]), params={"name": prev})
-
-            # ADD NEW attachment
-            files = {"file": (latest, data["attach"].getvalue())}
-            self.send("POST", "cards/{}/attachments".format(card_id), files=files)
-
-        b = next(b for b in board_data if b["id"] == card["idBoard"])
+            # DELETE previous version(s) if there are any, and rename old latest to previous.
+            # old latest has to be out of the way before the new one goes up.
+            # one step per attachment - a card can end up with more than one of each.
+            # none of it again once this version's up - and an old latest renamed last try is now the previous
+            if "upload" not in done:
+                deletes = [plan.add("delete previous {}".format(a["id"]), self.send,
+                                    ("DELETE", "cards/{}/attachments/{}".format(card_id, a["id"])))
+                           for a in card["attachments"]
+                           if a["name"] == prev and "rename latest {}".format(a["id"]) not in done]
+                renames = []
+                for a in card["attachments"]:
+                    if a["name"] == latest:
+                        name = "rename latest {}".format(a["id"])
+                        renames.append(plan.add(name, record(name, self.send),
+                                                ("PUT", "cards/{}/attachments/{}".format(card_id, a["id"])),
+                                                {"params": {"name": prev}}, deps=deletes))
+
+                # ADD NEW attachment - streamed from the file-like, never copied whole
+                files = {"file": (latest, data["attach"])}
+                plan.add("upload", record("upload", self.send), ("POST", "cards/{}/attachments".format(card_id)),
+                         {"files": files}, deps=deletes + renames)
+
+            # videos come with a poster frame - make it the cover, so the board shows something
+            # without anyone downloading the whole video
+            if data.get("poster") and "cover" not in done:
+                old_posters = [a["id"] for a in card["attachments"] if a["name"] == self.poster_name]
+                # the poster's only finished once the video is
+                plan.add("cover", record("cover", self.upload_cover), (card_id, data["poster"], old_posters),
+                         deps=["upload"])
+
         # PUT custom fields if necessary
-        for cf in b["customFields"]:
+        for cf in fields:
             for cf_name, text_value in ("Status", "Review Needed"), ("Type", data["type"]):
                 if cf_name == cf["name"]:
                     option_id = next(item["id"] for item in cf["options"] if item["value"]["text"] == text_value)
                     # curr_val = next(ccf["value"] for ccf in card["customFieldItems"] if ccf["id"] == cf["id"])
-                    self.send("PUT", "card/{}/customField/{}/item".format(card_id, cf["id"]),
-                              params={"idValue": option_id})
+                    plan.add("field {}".format(cf_name), self.send,
+                             ("PUT", "card/{}/customField/{}/item".format(card_id, cf["id"])),
+                             {"params": {"idValue": option_id}})
                     break
 
+        try:
+            plan.run()
+        finally:
+            print(plan.report())
+
+
+    def upload_cover(self, card_id, path, replace=()):
+        """
+        Attach an image to a card as its cover, then delete the ones it replaces.
+        :param card_id: the card
+        :param path: image file. if it isn't there (ie ffmpeg couldn't make it), nothing happens -
+        the card keeps the cover it had
+        :param replace: ids of old cover attachments to delete once the new one's up
+        :return: json of the attachment, or None
+        """
+        if not os.path.isfile(path):
+            print("No poster made for card {}, cover left as it was".format(card_id))
+            return None
+        with open(path, "rb") as f:
+            cover = self.send("POST", "cards/{}/attachments".format(card_id), params={"setCover": "true"},
+                              files={"file": (self.poster_name, f)})
+        self.send_many([("DELETE", "cards/{}/attachments/{}".format(card_id, a), {}) for a in replace])
+        return cover
 
-    def get_card(self, board_data, publish_data):
+
+    def get_card(self, publish_data):
         """
         Guaranteed GET of a Trello card - whether there is a saved ID that is good or bad,
         or if no task or entity or even category exists on Trello.
-        :param data: dict - the publish data
-        :param board_data: dict - Trello json
-        :return:
+        Only fetches what it needs: with a good saved ID that's the card and its board's custom fields,
+        otherwise the board, then its lists, then the entity's cards.
+        The whole team's data is only the last resort.
+        :param publish_data: dict - the publish data
+        :return: card json, card id, list of custom field definitions of the card's board
         """
         config = os.path.join(publish_data["task_path"], "taskinfo.ini")
         card_id = self.core.getConfig("trello", "id", configPath=config)
-        if not card_id:
-            card = self.ensure_card_exists(board_data, publish_data)
+        # ids saved on sync
+        board_id = list_id = None
+        if publish_data.get("entity_path"):
+            entity_config = os.path.join(publish_data["entity_path"], "entityinfo.ini")
+            board_id = self.core.getConfig("trello", "board_id", configPath=entity_config)
+            list_id = self.core.getConfig("trello", "list_id", configPath=entity_config)
+
+        card = fields = None
+        if card_id:
+            # it's possible that the saved ID is no longer valid.
+            # in which case, try to re-find / re-create it.
+            card, fields = self._get_card_by_id(card_id, board_id)
+        if card is None:
+            card, fields = self._find_card(publish_data, board_id, list_id)
+        if card is None:
+            with self.lock:
+                live = self.is_live()
+                board_data = self.get_board_data(live=live)[publish_data["pipe"]]
+                if live and not self._snapshot_has_card(publish_data):
+                    # the webhooks might just not have caught it - make sure before making anything
+                    board_data = self.get_board_data()[publish_data["pipe"]]
+                card = self.ensure_card_exists(board_data, publish_data)
+                fields = self.snapshot.boards[card["idBoard"]]["customFields"]
+
+        if card["id"] != card_id:
             card_id = card["id"]
             self.core.setConfig("trello", "id", card_id, configPath=config)
-        else:
-            try:
-                card = self.send("GET", "cards/{}".format(card_id),
-                                 params={"customFieldItems": "true", "attachments": "true"})
-            except NotFound:
-                # it's possible that the saved ID is no longer valid.
-                # try to re-find / re-create it.
-                card = self.ensure_card_exists(board_data, publish_data)
-                card_id = card["id"]
-                self.core.setConfig("trello", "id", card_id, configPath=config)
 
-        return card, card_id
+        return card, card_id, fields
+
+
+    def _get_card_by_id(self, card_id, board_id=None):
+        """
+        Get a card and the custom field definitions of its board.
+        :param card_id: id of the card
+        :param board_id: id of the board it's probably on. if given, card & fields are asked for at once
+        :return: card json & list of custom fields, or None, None if the card is gone
+        """
+        calls = [("GET", "cards/{}".format(card_id), {"params": self.card_params()})]
+        if board_id:
+            calls.append(("GET", "boards/{}/customFields".format(board_id), {}))
+        try:
+            results = self.send_many(calls)
+        except NotFound:
+            results = [None]
+            if board_id:
+                # might be the board that's gone rather than the card
+                try:
+                    results = [self.send("GET", "cards/{}".format(card_id), params=self.card_params())]
+                except NotFound:
+                    pass
+        card = results[0]
+        fields = results[1] if len(results) > 1 else None
+
+        if not card:
+            return None, None
+        if fields is None or card["idBoard"] != board_id:
+            fields = self.send("GET", "boards/{}/customFields".format(card["idBoard"]))
+        return card, fields
+
+
+    def _find_card(self, publish_data, board_id=None, list_id=None):
+        """
+        Look up the card for this publish going board -> list -> cards, only fetching those.
+        Creates the card if the list exists but the card doesn't.
+        :param publish_data: data squeezed out of the filepaths of the publish
+        :param board_id: saved id of the entity's board, if any
+        :param list_id: saved id of the entity's list, if any
+        :return: card json & list of custom fields, or None, None if the board or list isn't there
+        """
+        if not board_id:
+            board = self._find_board(publish_data["pipe"], publish_data["category"])
+            if not board:
+                return None, None
+            board_id = board["id"]
+
+        lists, fields = (r.get("200") for r in self.batch_get(
+            ["/boards/{}/lists/open".format(board_id), "/boards/{}/customFields".format(board_id)]))
+        if lists is None or fields is None:
+            return None, None
+
+        entity = publish_data["entity"].lower()
+        l = next((l for l in lists if l["id"] == list_id), None) or \
+            next((l for l in lists if self.name_key(l["name"]) == entity), None)
+        if not l:
+            return None, None
+
+        cards = self.send("GET", "lists/{}/cards".format(l["id"]), params=self.card_params())
+        task = publish_data["task"].lower()
+        c = next((c for c in cards if task == self.name_key(c["name"])), None)
+        if not c:
+            c = self._create_card(publish_data["task"], l["id"])
+        return c, fields
+
+
+    def _find_board(self, pipe, category):
+        """
+        Find a board by name without getting anything else.
+        :param pipe: assets or shots
+        :param category: name of the board, with any subcategories joined Trello style (by "/")
+        :return: board json (id, name & prefs only), or None
+        """
+        boards = self.send("GET", "organizations/{}/boards".format(self.team_id),
+                           params={"fields": "name,prefs"})
+        return next((b for b in boards if TeamSnapshot.sector(b) == pipe and
+                     self.board_key(b["name"]) == category.lower()), None)
+
+
+    def _snapshot_has_card(self, publish_data):
+        """
+        :param publish_data: data squeezed out of the filepaths of the publish
+        :return: bool - whether the snapshot has the publish's board, list and card,
+        ie ensure_card_exists wouldn't have to make anything
+        """
+        b = self.snapshot.find_board(publish_data["pipe"], publish_data["category"].lower())
+        l = b and self.snapshot.find_list(b["id"], publish_data["entity"].lower())
+        task = publish_data["task"].lower()
+        return bool(l) and any(task == self.name_key(c["name"]) for c in l["cards"])
 
 
     def ensure_card_exists(self, board_data, publish_data):
@@ -507,52 +1294,80 @@ class TrelloHandler(object):
 
         task = publish_data["task"].lower()
         try:
-            c = next(c for c in l["cards"] if task == self.validate_string(c["name"]).lower())
+            c = next(c for c in l["cards"] if task == self.name_key(c["name"]))
         except StopIteration:
-            new_card = {"name": publish_data["task"],
-                        "idList": l["id"]}
-            c = self.send("POST", "cards/", params=new_card)
-            # gotta re-get 'cause, again, posting doesn't return attachments & custom fields
-            c = self.send("GET", "cards/{}".format(c["id"]),
-                             params={"customFieldItems": "true", "attachments": "true"})
-            l["cards"].append(c)
+            c = self._create_card(publish_data["task"], l["id"])
+            self.snapshot.add_card(c)
 
         return c
 
 
+    def _create_card(self, name, list_id):
+        """
+        Make a new card.
+        :param name: name of the card
+        :param list_id: list to put it in
+        :return: card json, with customFieldItems & attachments
+        """
+        new_card = {"name": name,
+                    "idList": list_id}
+        c = self.send("POST", "cards/", params=new_card)
+        # gotta re-get 'cause, again, posting doesn't return attachments & custom fields
+        return self.send("GET", "cards/{}".format(c["id"]), params=self.card_params())
+
+
+    def board_key(self, name):
+        """
+        Data is compared as LOCAL - because we can't UNVALIDATE the string.
+        :param name: Trello board name, with any subcategories joined by "/"
+        :return: validated, lowercase version to compare against the Prism category
+        """
+        return "/".join(self.name_key(c) for c in name.split("/"))
+
+
     def get_category_board(self, board_data, pipe, category):
         """
         Conveniece function to guaranteed get board json.
         Tries to find by name lookup but creates a new board if there is no match.
         Looks to cloud templates for easy copying.
-        :param board_data: big ol' dict (only for this pipe tho)
+        :param board_data: list of board json (only for this pipe tho) - the snapshot's sector,
+        which is looked up through the snapshot's name index
         :param pipe: assets or shots - affects which template board is copied
         :param category: name of the board, with any subcategories joined Trello style (by "/")
         :return: board json dict
         """
         # template_id = next(t["id"] for t in board_data if "template" in t["name"].lower())
-        # data is compared as LOCAL - because we can't UNVALIDATE the string
         # validate trello string(s) and compare the lowers
-        valid_bname = lambda bn: "/".join((self.validate_string(c) for c in bn.split("/"))).lower()
-        try:
-            b = next(b for b in board_data if valid_bname(b["name"]) == category.lower())
-        except StopIteration:
+        b = self.snapshot.find_board(pipe, category.lower())
+        if b is None:
             # if no match is found... make a new board
-            new_board = {"name": category,
-                         "idOrganization": self.team_id,
-                         "idBoardSource": self.template_boards[pipe],
-                         "prefs_permissionLevel": "org", }
-            b = self.send("POST", "boards/", params=new_board)
-            # posting it doesn't return all the board info sometimes, so get it all here if necessary
-            b = self.send("GET", "boards/{}?lists=open&customFields=true".format(b["id"]))
-            # scrub template lists
-            for l in b["lists"]: self.send("PUT", "lists/{}/closed?value=true".format(l["id"]))
-
-            board_data.append(b)
+            b = self._create_board(pipe, category)
 
         return b
 
 
+    def _create_board(self, pipe, category):
+        """
+        Make a board from the pipe's template and add it to the snapshot.
+        :param pipe: assets or shots - affects which template board is copied
+        :param category: name of the board
+        :return: board json dict
+        """
+        new_board = {"name": category,
+                     "idOrganization": self.team_id,
+                     "idBoardSource": self.template_boards[pipe],
+                     "prefs_permissionLevel": "org", }
+        b = self.send("POST", "boards/", params=new_board)
+        # posting it doesn't return all the board info sometimes, so get it all here if necessary
+        b = self.send("GET", "boards/{}?lists=open&customFields=true".format(b["id"]))
+        # scrub template lists
+        self.send_many([("PUT", "lists/{}/closed?value=true".format(l["id"]), {}) for l in b.pop("lists")])
+
+        # lands in the snapshot's sector for this pipe, going by the template's color
+        with self.lock:
+            return self.snapshot.set_board(b, [], b.pop("customFields"), [])
+
+
     def get_entity_list(self, board, entity):
         """
         Get the Trello json for the given entity on the given board.
@@ -561,13 +1376,71 @@ class TrelloHandler(object):
         :param entity: name of the asset/shot
         :return: list json dict
         """
-        try:
-            l = next(l for l in board["lists"] if self.validate_string(l["name"]).lower() == entity.lower())
-        except StopIteration:
-            new_list = {"name": entity,
-                        "idBoard": board["id"], }
-            l = self.send("POST", "lists/", params=new_list)
-            l["cards"] = []
-            board["lists"].append(l)
+        l = self.snapshot.find_list(board["id"], entity.lower())
+        if l is None:
+            l = self._create_list(board, entity)
 
         return l
+
+
+    def _create_list(self, board, entity, pos=None):
+        """
+        Make a list on a board and add it to the snapshot.
+        :param board: board json dict
+        :param entity: name of the asset/shot
+        :param pos: optional position on the board - otherwise it goes at the end
+        :return: list json dict
+        """
+        new_list = {"name": entity,
+                    "idBoard": board["id"], }
+        if pos is not None:
+            new_list["pos"] = pos
+        l = self.send("POST", "lists/", params=new_list)
+        with self.lock:
+            return self.snapshot.add_list(l)
+
+
+def list_dirs(pool, folders):
+    """
+    List several folders at once.
+    :param pool: ThreadPool to do it on
+    :param folders: folder paths
+    :return: dict of folder : set of the (normcased) names in it. missing folders are empty
+    """
+    folders = list(folders)
+
+    def listing(folder):
+        try:
+            return set(os.path.normcase(n) for n in os.listdir(folder))
+        except OSError:
+            return set()
+    return dict(zip(folders, pool.map(listing, folders))) if folders else {}
+
+
+def has_dir(listings, path):
+    """
+    :param listings: from list_dirs, including path's parent
+    :param path: folder to look for
+    :return: bool - whether it's in its parent's listing
+    """
+    parent, name = os.path.split(path)
+    return os.path.normcase(name) in listings.get(parent, ())
+
+
+def make_entity_dirs(job):
+    """
+    Make the missing folders of one entity. Runs on the sync's thread pool.
+    :param job: (basepath, whether the entity itself is new, [task paths to make])
+    :return: None
+    """
+    basepath, new, task_paths = job
+    if new:
+        task_paths = [os.path.join(basepath, x) for x in ("Export", "Playblasts", "Rendering", "Scenefiles")] + \
+                     list(task_paths)
+    for path in task_paths:
+        try:
+            os.makedirs(path)
+        except OSError:
+            # already there is fine - the scan might be a bit behind
+            if not os.path.isdir(path):
+                raise
@@ -5,7 +5,7 @@ try:
 except ImportError:
     from PySide.QtCore import *
     from PySide.QtGui import *
-import webbrowser
+import time, threading, traceback, webbrowser
 
 
 class LinkDialog(QDialog):
@@ -63,11 +63,146 @@ class TrelloSettingsUi(QGroupBox):
         layout.addWidget(self.templates_button)
 
         self.sync_down_button = QPushButton("Sync Trello -> Prism", self)
-        self.sync_down_button.setToolTip("Get new data from Trello and create in Prism project.")
+        self.sync_down_button.setToolTip("Get new data from Trello and create in Prism project.\n"
+                                         "Only boards changed since the last sync are looked at - "
+                                         "right click for a full resync.")
         layout.addWidget(self.sync_down_button)
+        self.sync_down_full_action = QAction("Full resync (every board)", self.sync_down_button)
+        self.sync_down_button.addAction(self.sync_down_full_action)
+        self.sync_down_button.setContextMenuPolicy(Qt.ActionsContextMenu)
         self.sync_up_button = QPushButton("Sync Prism -> Trello", self)
-        self.sync_up_button.setToolTip("Get data from Prism project and push to Trello team.")
+        self.sync_up_button.setToolTip("Get data from Prism project and push to Trello team.\n"
+                                       "Right click for a dry run.")
         layout.addWidget(self.sync_up_button)
+        # extra options on right click
+        self.sync_up_dry_run_action = QAction("Dry run (print what would be created)", self.sync_up_button)
+        self.sync_up_button.addAction(self.sync_up_dry_run_action)
+        self.sync_up_button.setContextMenuPolicy(Qt.ActionsContextMenu)
+
+
+class SyncWorker(QObject):
+    """
+    Runs a sync on its own thread, so the UI carries on while it goes.
+    Progress and the outcome come back as signals, which Qt delivers on the UI thread.
+    """
+    maximum = Signal(int)
+    progress = Signal(int)
+    # "done", "cancelled" or "failed", and the error text if it failed
+    finished = Signal(str, str)
+
+    def __init__(self, func):
+        """
+        :param func: the sync - function taking (set_max_func, increment_func, cancel event)
+        """
+        super(SyncWorker, self).__init__()
+        self.func = func
+        self.cancel = threading.Event()
+        self.count = 0
+
+
+    def run(self):
+        try:
+            self.func(self.maximum.emit, self.increment, self.cancel)
+            status, error = ("cancelled" if self.cancel.is_set() else "done"), ""
+        except Exception:
+            traceback.print_exc()
+            status, error = "failed", traceback.format_exc().strip().splitlines()[-1]
+        self.finished.emit(status, error)
+
+
+    def increment(self):
+        self.count += 1
+        self.progress.emit(self.count)
+
+
+class SyncProgressDialog(QProgressDialog):
+    """
+    Progress of a SyncWorker, with throughput & an ETA. Cancel stops the sync before the next entity.
+    Not modal - Prism stays usable while it runs.
+    """
+    def __init__(self, title, func, stats_func=None, parent=None):
+        """
+        :param title: label text, ie "Downloading changes from Trello..."
+        :param func: the sync, see SyncWorker
+        :param stats_func: optional function returning a dict with a "requests" count (ie RateLimiter.stats)
+        :param parent: parent widget
+        """
+        super(SyncProgressDialog, self).__init__(title, "Cancel", 0, 0, parent)
+        self.title = title
+        self.stats_func = stats_func
+        self.setWindowTitle("Trello")
+        self.setAutoClose(False)
+        self.setAutoReset(False)
+        self.setMinimumDuration(0)
+
+        self.worker = SyncWorker(func)
+        self.worker_thread = QThread()
+        self.worker.moveToThread(self.worker_thread)
+        self.worker_thread.started.connect(self.worker.run)
+        self.worker.maximum.connect(self.setMaximum)
+        self.worker.progress.connect(self.on_progress)
+        self.worker.finished.connect(self.on_finished)
+        self.canceled.connect(self.on_cancel)
+        # set once the sync's over, see SyncWorker.finished
+        self.status = None
+        self.start = None
+        self.start_requests = 0
+
+
+    def run(self):
+        """
+        Show the dialog and start the sync. Returns straight away.
+        :return: None
+        """
+        self.start = time.time()
+        self.start_requests = self.requests()
+        self.show()
+        self.worker_thread.start()
+
+
+    def requests(self):
+        return self.stats_func()["requests"] if self.stats_func else 0
+
+
+    def on_progress(self, count):
+        self.setValue(min(count, self.maximum()))
+        elapsed = max(time.time() - self.start, 0.001)
+        rate = count / elapsed
+        lines = [self.title, "{} / {} done - {:.1f}/s, {:.1f} requests/s".format(
+            count, self.maximum(), rate, (self.requests() - self.start_requests) / elapsed)]
+        if rate and self.maximum() > count:
+            lines.append("About {} left".format(format_duration((self.maximum() - count) / rate)))
+        self.setLabelText("\n".join(lines))
+
+
+    def on_cancel(self):
+        # QProgressDialog hides itself on cancel - keep it up until the sync really stops
+        self.worker.cancel.set()
+        self.setLabelText("{}\nCancelling, after what's already going...".format(self.title))
+        self.setCancelButton(None)
+        self.show()
+
+
+    def on_finished(self, status, error):
+        self.status = status
+        self.worker_thread.quit()
+        self.worker_thread.wait()
+        self.hide()
+        if status == "done":
+            QMessageBox(text="Sync complete.").exec_()
+        elif status == "cancelled":
+            QMessageBox(text="Sync cancelled.\nAnything already made has been kept.").exec_()
+        else:
+            QMessageBox.critical(None, "Trello", "Sync failed:\n{}".format(error))
+
+
+def format_duration(seconds):
+    """
+    :param seconds: float
+    :return: string, ie "1m 05s"
+    """
+    minutes, seconds = divmod(int(seconds + 0.5), 60)
+    return "{}m {:02d}s".format(minutes, seconds) if minutes else "{}s".format(seconds)
 
 
 def get_project_config(core, keys, proj="trello"):
@@ -95,3 +230,12 @@ def get_project_config(core, keys, proj="trello"):
         data[k] = v
 
     return data
+
+
+def on_main_thread():
+    """
+    Qt widgets can only be touched from the main thread.
+    :return: bool, whether this is running on it (or there's no app at all)
+    """
+    app = QCoreApplication.instance()
+    return app is None or QThread.currentThread() == app.thread()
@@ -0,0 +1,246 @@
+import os, time, shutil, threading, traceback, uuid
+import requests
+from trelloprism import Unauthorized, Unavailable
+from trelloconfig import write_json, read_json
+
+"""
+On-disk queue for publishes, so the DCC isn't stuck waiting on Trello.
+Each queued publish is a folder holding its job.json (and any attachment grabbed up front).
+A background worker sends them in order, and they only leave the disk once they're on Trello -
+so if Prism crashes or the internet is out, they're replayed later.
+Every Prism process (DCC, Project Browser) runs a worker on the same queue, so a worker
+claims a job by moving it into its own working folder before sending it.
+"""
+
+
+class NotReady(Exception):
+    # raised by the process function when it can't publish yet (ie no Trello connection)
+    pass
+
+
+class PublishQueue(object):
+    # seconds to wait before retrying a failed publish. the last one repeats
+    retry_delays = (5, 15, 60, 300)
+    # give up after this many real errors (offline / unauthorized / Trello down doesn't count)
+    max_attempts = 6
+    # seconds between a worker's heartbeats, and how long without one until its claims are taken back
+    heartbeat = 30
+    stale_after = 300
+
+    def __init__(self, root, process_func, project=None):
+        """
+        :param root: folder to keep the queue in
+        :param process_func: function taking (job data dict, job dir) which publishes it.
+        raises on failure.
+        :param project: what the jobs belong to (ie prismIni). jobs put by another project are left alone
+        """
+        self.root = root
+        self.process = process_func
+        self.project = project
+        self.pending_dir = os.path.join(root, "pending")
+        self.failed_dir = os.path.join(root, "failed")
+        self.tmp_dir = os.path.join(root, "tmp")
+        self.working_root = os.path.join(root, "working")
+        # this process's claimed jobs. other workers' folders sit next to it
+        self.working_dir = os.path.join(self.working_root, "{}-{}".format(os.getpid(), uuid.uuid4().hex[:8]))
+        for d in (self.pending_dir, self.failed_dir, self.tmp_dir, self.working_dir):
+            if not os.path.exists(d):
+                os.makedirs(d)
+
+        self.wake = threading.Event()
+        self.stopped = False
+        self.thread = None
+        self.beat_thread = None
+
+
+    def put(self, data, files=None):
+        """
+        Write a publish to the queue and poke the worker. Returns as soon as it's on disk.
+        :param data: json-able dict of publish data
+        :param files: optional dict of {filename: bytes or readable} to store alongside the job
+        :return: string - the job's id
+        """
+        job_id = "{:017.6f}-{}".format(time.time(), uuid.uuid4().hex[:8])
+        # build it in tmp then move it over, so the worker never sees half a job
+        job_dir = os.path.join(self.tmp_dir, job_id)
+        os.makedirs(job_dir)
+        for name, content in (files or {}).items():
+            with open(os.path.join(job_dir, name), "wb") as f:
+                if hasattr(content, "read"):
+                    shutil.copyfileobj(content, f)
+                else:
+                    f.write(content)
+        write_json(os.path.join(job_dir, "job.json"),
+                   {"data": data, "project": self.project, "attempts": 0, "next_try": 0})
+        os.rename(job_dir, os.path.join(self.pending_dir, job_id))
+
+        self.start()
+        self.wake.set()
+        return job_id
+
+
+    def pending(self):
+        """
+        :return: sorted list of queued job ids, oldest first
+        """
+        return sorted(os.listdir(self.pending_dir))
+
+
+    def start(self):
+        """
+        Start the worker if it isn't running. Anything left over from before gets replayed.
+        :return: None
+        """
+        if self.thread and self.thread.is_alive():
+            return
+        self.stopped = False
+        if not os.path.exists(self.working_dir):
+            os.makedirs(self.working_dir)
+        self._beat()
+        if not (self.beat_thread and self.beat_thread.is_alive()):
+            self.beat_thread = threading.Thread(target=self._keep_beating, name="PrismTrelloPublishQueueBeat")
+            self.beat_thread.daemon = True
+            self.beat_thread.start()
+        self.thread = threading.Thread(target=self._run, name="PrismTrelloPublishQueue")
+        self.thread.daemon = True
+        self.thread.start()
+
+
+    def stop(self):
+        """
+        Stop the worker after whatever it's sending right now. Queued jobs stay on disk.
+        :return: None
+        """
+        self.stopped = True
+        self.wake.set()
+
+
+    def _run(self):
+        """
+        Worker loop - send due jobs oldest first, then sleep until the next one is due
+        or something new is put in the queue.
+        :return: None
+        """
+        while not self.stopped:
+            self.wake.clear()
+            self.release_stale()
+            # wake up now and then for jobs a dead worker left behind
+            wait = self.stale_after
+            for job_id in self.pending():
+                if self.stopped:
+                    break
+                delay = self._try_job(job_id)
+                if delay:
+                    # keep order - nothing behind a stuck job goes before it
+                    wait = min(delay, wait)
+                    break
+            if not self.stopped:
+                self.wake.wait(wait)
+        # a stopped worker holds no claims (see _try_job), so nobody has to wait out its heartbeat
+        shutil.rmtree(self.working_dir, ignore_errors=True)
+
+
+    def _beat(self):
+        """
+        Show other workers this one is still alive, so its claims aren't taken back.
+        :return: None
+        """
+        try:
+            with open(os.path.join(self.working_dir, "alive"), "w") as f:
+                f.write(str(time.time()))
+        except (IOError, OSError):
+            pass
+
+
+    def _keep_beating(self):
+        # on its own thread - a single publish (ie an encode) can take longer than stale_after
+        while not self.stopped:
+            self._beat()
+            time.sleep(self.heartbeat)
+
+
+    def release_stale(self):
+        """
+        Put jobs claimed by workers which stopped beating (ie their Prism crashed) back in the queue.
+        :return: list of the job ids put back
+        """
+        released = []
+        for owner in os.listdir(self.working_root):
+            owner_dir = os.path.join(self.working_root, owner)
+            if owner_dir == self.working_dir:
+                continue
+            alive = os.path.join(owner_dir, "alive")
+            try:
+                last = os.path.getmtime(alive if os.path.exists(alive) else owner_dir)
+            except OSError:
+                # another worker just cleaned it up
+                continue
+            if time.time() - last < self.stale_after:
+                continue
+            for job_id in os.listdir(owner_dir):
+                if job_id == "alive":
+                    continue
+                try:
+                    os.rename(os.path.join(owner_dir, job_id), os.path.join(self.pending_dir, job_id))
+                    released.append(job_id)
+                except OSError:
+                    # someone else got to it first
+                    pass
+            shutil.rmtree(owner_dir, ignore_errors=True)
+        return released
+
+
+    def _try_job(self, job_id):
+        """
+        Attempt to send one job. It's claimed first, and put back in pending if it has to wait.
+        :param job_id: name of the job's folder
+        :return: seconds until it should be tried again, or None if it's done with
+        (or not this worker's to send)
+        """
+        job_dir = os.path.join(self.pending_dir, job_id)
+        job = read_json(os.path.join(job_dir, "job.json"))
+        if job is not None:
+            if job.get("project", self.project) != self.project:
+                return None
+            remaining = job["next_try"] - time.time()
+            if remaining > 0:
+                return remaining
+
+        # moving it is atomic - if another worker got it first, this fails and it's theirs
+        claimed_dir = os.path.join(self.working_dir, job_id)
+        try:
+            os.rename(job_dir, claimed_dir)
+        except OSError:
+            return None
+        job_dir, job_file = claimed_dir, os.path.join(claimed_dir, "job.json")
+        # what was read before claiming may be out of date by now
+        job = read_json(job_file)
+        if job is None:
+            # junk from a crash mid-write. nothing to replay
+            shutil.rmtree(job_dir, ignore_errors=True)
+            return None
+
+        try:
+            self.process(job["data"], job_dir)
+        except (requests.ConnectionError, requests.Timeout, Unauthorized, Unavailable, NotReady) as e:
+            # offline, logged out or Trello's down - not the publish's fault, so don't count it
+            print("Trello publish {} queued until connection returns: {}".format(job_id, e))
+            delay = self.retry_delays[min(job.get("offline", 0), len(self.retry_delays) - 1)]
+            job["offline"] = job.get("offline", 0) + 1
+        except Exception:
+            traceback.print_exc()
+            job["attempts"] += 1
+            if job["attempts"] >= self.max_attempts:
+                print("Trello publish {} failed {} times, moved to {}".format(
+                    job_id, job["attempts"], self.failed_dir))
+                os.rename(job_dir, os.path.join(self.failed_dir, job_id))
+                return None
+            delay = self.retry_delays[min(job["attempts"] - 1, len(self.retry_delays) - 1)]
+        else:
+            shutil.rmtree(job_dir, ignore_errors=True)
+            return None
+
+        job["next_try"] = time.time() + delay
+        write_json(job_file, job)
+        os.rename(job_dir, os.path.join(self.pending_dir, job_id))
+        return delay
@@ -0,0 +1,106 @@
+import uuid
+from io import BytesIO
+
+"""
+Upload bodies that are read in chunks as they're sent, instead of being built in memory.
+"""
+
+
+class MultipartStream(object):
+    """
+    A multipart/form-data body with one file in it, read straight from a file-like object.
+    Hand it to requests as data= (with content_type as the Content-Type header):
+    if the file's size can be told it goes with a Content-Length, otherwise chunked.
+    """
+    chunk_size = 64 * 1024
+
+    def __init__(self, field, filename, fileobj, mimetype="application/octet-stream"):
+        """
+        :param field: form field name, ie "file"
+        :param filename: name the file gets on the other end
+        :param fileobj: readable file-like - file, BytesIO, pipe...
+        :param mimetype: content type of the file part
+        """
+        self.boundary = "prismtrello-{}".format(uuid.uuid4().hex)
+        self.head = ('--{}\r\nContent-Disposition: form-data; name="{}"; filename="{}"\r\n'
+                     'Content-Type: {}\r\n\r\n').format(self.boundary, field, filename, mimetype).encode("utf-8")
+        self.tail = "\r\n--{}--\r\n".format(self.boundary).encode("utf-8")
+        self.fileobj = fileobj
+        self.content_type = "multipart/form-data; boundary={}".format(self.boundary)
+
+        # size & start are only known for seekable files. pipes go chunked
+        self.start = tell(fileobj)
+        self.length = 0
+        if self.seekable:
+            fileobj.seek(0, 2)
+            size = fileobj.tell() - self.start
+            fileobj.seek(self.start)
+            self.length = len(self.head) + size + len(self.tail)
+        self.rewind()
+
+
+    def __len__(self):
+        # 0 tells requests to send it chunked
+        return self.length
+
+
+    def __bool__(self):
+        # never falsy, even when the length isn't known - requests does "data or {}"
+        return True
+    __nonzero__ = __bool__
+
+
+    def __iter__(self):
+        while True:
+            chunk = self.read(self.chunk_size)
+            if not chunk:
+                return
+            yield chunk
+
+
+    @property
+    def seekable(self):
+        return self.start is not None
+
+
+    def rewind(self):
+        """
+        Start over from the top, ie to send it again. Only works for seekable files.
+        :return: None
+        """
+        if getattr(self, "parts", None):
+            if not self.seekable:
+                raise IOError("Can't rewind a stream that isn't seekable")
+            self.fileobj.seek(self.start)
+        self.parts = [BytesIO(self.head), self.fileobj, BytesIO(self.tail)]
+        self.part = 0
+
+
+    def read(self, size=-1):
+        """
+        :param size: max bytes to read, or -1 for everything that's left
+        :return: bytes - empty when it's all been read
+        """
+        out = []
+        count = 0
+        while self.part < len(self.parts) and (size is None or size < 0 or count < size):
+            data = self.parts[self.part].read(-1 if size is None or size < 0 else size - count)
+            if not data:
+                self.part += 1
+                continue
+            out.append(data)
+            count += len(data)
+        return b"".join(out)
+
+
+def tell(fileobj):
+    """
+    :param fileobj: file-like
+    :return: current position, or None if it isn't seekable (ie a pipe)
+    """
+    try:
+        pos = fileobj.tell()
+        fileobj.seek(pos)
+        return pos
+    except (AttributeError, IOError, OSError, ValueError):
+        return None
@@ -0,0 +1,80 @@
+import os, sys, time, shutil, argparse, subprocess
+from tempfile import mkdtemp
+
+"""
+Compare the preview encoder profiles on a synthetic frame sequence.
+    python benchmarks/bench_encoder_profiles.py --frames 240 --size 1920x1080
+Needs ffmpeg (with libvpx) on the PATH, or pass --ffmpeg.
+"""
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "Scripts"))
+import trellomedia
+
+
+def make_frames(ffmpeg, folder, frames, size, fps):
+    """
+    Render ffmpeg's moving test pattern out as a png sequence, like a playblast.
+    :return: string - frame pattern for ffmpeg input
+    """
+    pattern = os.path.join(folder, "bench.%04d.png")
+    subprocess.check_call([ffmpeg, "-v", "error", "-f", "lavfi",
+                           "-i", "testsrc2=size={}:rate={}".format(size, fps),
+                           "-frames:v", str(frames), "-start_number", "1", pattern])
+    return pattern
+
+
+def encode(ffmpeg, pattern, profile, frames, fps, max_size, threads):
+    """
+    :return: (seconds taken, output bytes)
+    """
+    args = [ffmpeg, "-framerate", str(fps), "-start_number", "1", "-i", pattern, "-an"]
+    args.extend(profile.args(frames, fps, max_size, threads))
+    args.extend(["-f", "webm", "-pix_fmt", "yuva420p", "-fs", str(max_size), "-"])
+
+    t = time.time()
+    video = trellomedia.FFmpegStream(args)
+    try:
+        while video.read(64 * 1024):
+            pass
+    finally:
+        video.close()
+    return time.time() - t, video.size
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare preview encoder profiles on a synthetic frame sequence.")
+    parser.add_argument("--ffmpeg", default="ffmpeg")
+    parser.add_argument("--frames", type=int, default=240)
+    parser.add_argument("--size", default="1920x1080", help="frame size, WxH")
+    parser.add_argument("--fps", type=int, default=24)
+    parser.add_argument("--max-size", type=int, default=8000000, help="output size cap in bytes")
+    parser.add_argument("--threads", type=int, default=None, help="defaults to the cpu count")
+    parser.add_argument("--profiles", nargs="*", default=sorted(trellomedia.EncoderProfile.profiles))
+    opts = parser.parse_args()
+
+    folder = mkdtemp(prefix="prismtrello_bench_")
+    try:
+        print("Rendering {} {} frames...".format(opts.frames, opts.size))
+        pattern = make_frames(opts.ffmpeg, folder, opts.frames, opts.size, opts.fps)
+
+        print("{:<10} {:>9} {:>8} {:>11} {:>10} {:>8}".format(
+            "profile", "seconds", "fps", "bitrate", "size", "fits"))
+        for name in opts.profiles:
+            profile = trellomedia.EncoderProfile.get(name)
+            bitrate = profile.bitrate(opts.frames, opts.fps, opts.max_size)
+            try:
+                seconds, size = encode(opts.ffmpeg, pattern, profile, opts.frames, opts.fps,
+                                          opts.max_size, opts.threads)
+            except trellomedia.EncodeError as e:
+                print("{:<10} failed: {}".format(name, e))
+                continue
+            # hitting the cap means -fs cut it short
+            print("{:<10} {:>9.2f} {:>8.1f} {:>10}k {:>9}k {:>8}".format(
+                name, seconds, opts.frames / seconds, bitrate // 1000, size // 1000,
+                "yes" if size < opts.max_size else "CUT"))
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+import os, sys, unittest
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "Scripts"))
+try:
+    from requests.compat import unquote
+    import trelloprism
+except ImportError as e:
+    # needs requests & PySide, ie Prism's python
+    raise unittest.SkipTest("trelloprism can't be imported: {}".format(e))
+
+"""
+TrelloHandler.batch_get - sub-urls have to survive being packed into one batch url.
+    python -m unittest discover tests
+"""
+
+
+class FakeTrello(object):
+    """
+    Answers /batch the way Trello reads it: the urls param is split on commas, then each is decoded.
+    Each result echoes the sub-url it was given.
+    """
+    def __init__(self, drop=0):
+        self.batches = []
+        # leave this many results off the end of each batch
+        self.drop = drop
+
+    def send_many(self, calls):
+        results = []
+        for method, uri, kwargs in calls:
+            self.assert_batch(method, uri)
+            query = uri.split("?", 1)[1]
+            # anything after an unencoded & would be another param of the batch request itself
+            urls = query[len("urls="):].split("&")[0].split(",")
+            self.batches.append(urls)
+            results.append([{"200": unquote(u)} for u in urls][:len(urls) - self.drop])
+        return results
+
+    @staticmethod
+    def assert_batch(method, uri):
+        assert method == "GET" and uri.startswith("/batch?urls="), uri
+
+
+class BatchGetTest(unittest.TestCase):
+    def handler(self, trello):
+        handler = object.__new__(trelloprism.TrelloHandler)
+        handler.send_many = trello.send_many
+        return handler
+
+    def test_sub_urls_keep_their_query(self):
+        queries = ["/boards/b1/actions?limit=1000&since=2026-01-01T00:00:00.000Z",
+                   "/cards/c1?customFieldItems=true&attachments=true",
+                   "/board/b1/lists/open"]
+        results = self.handler(FakeTrello()).batch_get(queries)
+        self.assertEqual([r["200"] for r in results], queries)
+
+    def test_chunks_keep_order(self):
+        trello = FakeTrello()
+        queries = ["/cards/c{}?attachments=true&customFieldItems=true".format(i) for i in range(25)]
+        results = self.handler(trello).batch_get(queries)
+        self.assertEqual([r["200"] for r in results], queries)
+        self.assertEqual([len(b) for b in trello.batches], [10, 10, 5])
+
+    def test_empty(self):
+        self.assertEqual(self.handler(FakeTrello()).batch_get([]), [])
+
+    def test_comma_rejected(self):
+        with self.assertRaises(ValueError):
+            self.handler(FakeTrello()).batch_get(["/boards/b1/cards?fields=name,desc"])
+
+    def test_result_count_checked(self):
+        with self.assertRaises(ValueError):
+            self.handler(FakeTrello(drop=1)).batch_get(["/board/b{}/lists/open".format(i) for i in range(3)])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,79 @@
+import os, sys, io, threading, unittest
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "Scripts"))
+from trelloplan import Plan
+try:
+    import trelloprism
+except ImportError:
+    # needs requests & PySide, ie Prism's python
+    trelloprism = None
+
+"""
+Publish plans on cards with more than one attachment of the same name - each needs its own step.
+    python -m unittest discover tests
+"""
+
+
+class PlanTest(unittest.TestCase):
+    def test_duplicate_step_rejected(self):
+        plan = Plan()
+        plan.add("rename latest", len, ("a",))
+        with self.assertRaises(ValueError):
+            plan.add("rename latest", len, ("b",))
+
+    def test_deps_wait(self):
+        order = []
+        plan = Plan(workers=4)
+        deletes = [plan.add("delete {}".format(i), order.append, ("delete",)) for i in range(3)]
+        renames = [plan.add("rename {}".format(i), order.append, ("rename",), deps=deletes) for i in range(3)]
+        plan.add("upload", order.append, ("upload",), deps=deletes + renames)
+        plan.run()
+        self.assertEqual(order, ["delete"] * 3 + ["rename"] * 3 + ["upload"])
+
+
+@unittest.skipIf(trelloprism is None, "trelloprism can't be imported")
+class PublishToCardTest(unittest.TestCase):
+    def setUp(self):
+        self.calls = []
+        self.lock = threading.Lock()
+        self.card = {"id": "c", "idList": "l", "desc": "", "url": "u", "attachments": [
+            {"id": "p1", "name": "PreviousVersion.mp4"}, {"id": "p2", "name": "PreviousVersion.mp4"},
+            {"id": "l1", "name": "LatestVersion.mp4"}, {"id": "l2", "name": "LatestVersion.mp4"},
+            {"id": "x1", "name": "Poster.jpg"}, {"id": "x2", "name": "Poster.jpg"}]}
+        handler = object.__new__(trelloprism.TrelloHandler)
+        handler.get_card = lambda data: (self.card, "c", [])
+        handler.send = self.send
+        handler.send_many = lambda calls: [self.send(c[0], c[1], **c[2]) for c in calls]
+        self.handler = handler
+
+    def send(self, method, uri, **kwargs):
+        with self.lock:
+            self.calls.append((method, uri))
+        return {}
+
+    def publish(self, **data):
+        data = dict({"task": "model", "version": "v0002", "author": "me", "comment": "c", "type": "Export",
+                     "attach": io.BytesIO(b"video"), "attach_type": "mp4"}, **data)
+        self.handler.publish_to_card(data)
+        return data
+
+    def test_every_attachment_rotated_once(self):
+        self.publish()
+        deletes = [i for i, c in enumerate(self.calls) if c[0] == "DELETE"]
+        renames = [i for i, c in enumerate(self.calls) if c[0] == "PUT" and "/attachments/" in c[1]]
+        upload = self.calls.index(("POST", "cards/c/attachments"))
+        self.assertEqual(sorted(self.calls[i][1] for i in deletes),
+                         ["cards/c/attachments/p1", "cards/c/attachments/p2"])
+        self.assertEqual(sorted(self.calls[i][1] for i in renames),
+                         ["cards/c/attachments/l1", "cards/c/attachments/l2"])
+        self.assertLess(max(deletes), min(renames))
+        self.assertLess(max(renames), upload)
+
+    def test_retry_skips_rotation(self):
+        data = self.publish()
+        self.calls[:] = []
+        self.publish(done_steps=data["done_steps"])
+        self.assertFalse([c for c in self.calls if "/attachments" in c[1]])
+
+
+if __name__ == "__main__":
+    unittest.main()
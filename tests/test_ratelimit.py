@@ -0,0 +1,75 @@
+import os, sys, bisect, unittest
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "Scripts"))
+try:
+    import trelloprism
+except ImportError as e:
+    # needs requests & PySide, ie Prism's python
+    raise unittest.SkipTest("trelloprism can't be imported: {}".format(e))
+
+"""
+RateLimiter on a simulated clock - no window of `period` seconds may hold more than `limit` requests.
+    python -m unittest discover tests
+"""
+
+
+class FakeClock(object):
+    # stands in for the time module inside trelloprism. sleeping just moves the clock on
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += max(seconds, 0)
+
+
+class RateLimiterTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.real_time = trelloprism.time
+        trelloprism.time = self.clock
+        self.limiter = trelloprism.RateLimiter(limit=100, period=10.0)
+        # send time of every request (a batch counts once per url)
+        self.sent = []
+
+    def tearDown(self):
+        trelloprism.time = self.real_time
+
+    def acquire(self, cost=1, gap=0.0):
+        self.clock.sleep(gap)
+        self.limiter.acquire(cost)
+        self.sent.extend([self.clock.now] * cost)
+
+    def busiest_window(self):
+        times = sorted(self.sent)
+        return max(bisect.bisect_left(times, t + self.limiter.period) - i for i, t in enumerate(times))
+
+    def test_burst(self):
+        for _ in range(350):
+            self.acquire()
+        self.assertLessEqual(self.busiest_window(), 100)
+        # the first 100 go at once, then 100 more every window
+        self.assertGreaterEqual(self.clock.now - 1000.0, 30.0)
+
+    def test_batches(self):
+        for i in range(60):
+            self.acquire(cost=10 if i % 3 else 1)
+        self.assertLessEqual(self.busiest_window(), 100)
+
+    def test_trickle(self):
+        # steady traffic under the limit is never held up
+        for _ in range(300):
+            self.acquire(gap=0.11)
+        self.assertEqual(self.limiter.throttled, 0)
+        self.assertLessEqual(self.busiest_window(), 100)
+
+    def test_backoff(self):
+        self.acquire()
+        self.limiter.backoff(5.0)
+        self.acquire()
+        self.assertGreaterEqual(self.sent[-1] - self.sent[0], 5.0)
+
+
+if __name__ == "__main__":
+    unittest.main()